@@ -1,7 +1,11 @@
 import MatchingEngine as engine
 import uuid
+from decimal import Decimal
 
 def get_id(id):
+    # order ids are integers; a UUID from eng.orderUuid() is accepted too
+    if id.strip().isdigit():
+        return int(id)
     uuid_string = id
     uuid_object = uuid.UUID(uuid_string)
     return uuid_object
@@ -23,20 +27,23 @@ def user_interface():
             side = input("Enter 'buy' or 'sell': ").lower()
 
             while True:
-                quantity = float(input("Enter quantity: "))
+                quantity = Decimal(input("Enter quantity: "))
                 if quantity >= 0:
                     break
                 else:
                     print("Error: Quantity must be non-negative. Please enter a valid value.")
 
             while True:
-                price = float(input("Enter price: "))
+                price = Decimal(input("Enter price: "))
                 if price >= 0:
                     break
                 else:
                     print("Error: Price must be non-negative. Please enter a valid value.")
 
-            order_id = eng.placeOrder(instrument, side, price, quantity)
+            try:
+                order_id = eng.placeOrder(instrument, side, price, quantity)
+            except ValueError as e:
+                print("Error:", e)
 
 
         elif choice == '2':
@@ -79,18 +86,23 @@ def show_trades(eng, inst):
     if trades == 0:
         print("No acknowledgements due to no trades")
 
-    for i in trades:
-        if eng.buyerAckQueue:
-            buy_ack = eng.buyerAckQueue.pop()
-            print("Buy filled:", buy_ack.order_id, buy_ack.side, buy_ack.instrument, buy_ack.price, buy_ack.filled_quantity)
-        else:
-            print("No buy acknowledgements")
-
-        if eng.sellerAckQueue:
-            sell_ack = eng.sellerAckQueue.pop()
-            print("Sale filled:", sell_ack.order_id, sell_ack.side, sell_ack.price, sell_ack.filled_quantity)
-        else:
-            print("No sell acknowledgements")
+    buy_acks = eng.buyerAckQueue.cursor('gui').drain()
+    sell_acks = eng.sellerAckQueue.cursor('gui').drain()
+
+    if buy_acks:
+        for buy_ack in buy_acks:
+            # the cursor drains acks of every instrument, each in its own tick and lot size
+            spec = eng.spec(buy_ack.instrument)
+            print("Buy filled:", buy_ack.order_id, buy_ack.side, buy_ack.instrument, spec.fromTicks(buy_ack.price), spec.fromLots(buy_ack.filled_quantity))
+    else:
+        print("No buy acknowledgements")
+
+    if sell_acks:
+        for sell_ack in sell_acks:
+            spec = eng.spec(sell_ack.instrument)
+            print("Sale filled:", sell_ack.order_id, sell_ack.side, spec.fromTicks(sell_ack.price), spec.fromLots(sell_ack.filled_quantity))
+    else:
+        print("No sell acknowledgements")
 
 
 if __name__ == "__main__":
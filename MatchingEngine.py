@@ -1,13 +1,174 @@
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import uuid
 import time
 import heapq
-import datetime
+import bisect
 import  json
+from decimal import Decimal
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; only needed to pass structured arrays to placeOrders
+    np = None
+import events
+import instrumentation
+import journal
+import risk
+import snapshot
+from ringBuffer import RingBuffer, RingFullError
+from events import Event
+from tradeTape import Trade, TradeTapes
+
+# Order types. Limit and post-only orders rest whatever does not trade
+# (post-only is rejected instead if it would trade at all); market, IOC and
+# FOK orders never rest, and a FOK is rejected unless it can fill entirely,
+# icebergs' hidden reserves included.
+# Stop and stop-limit orders wait in the instrument's StopBook until a trade
+# reaches their stop price, then become a market or limit order.
+LIMIT = 'limit'
+MARKET = 'market'
+IOC = 'ioc'
+FOK = 'fok'
+POST_ONLY = 'post_only'
+STOP = 'stop'
+STOP_LIMIT = 'stop_limit'
+ORDER_TYPES = (LIMIT, MARKET, IOC, FOK, POST_ONLY, STOP, STOP_LIMIT)
+RESTING_TYPES = (LIMIT, POST_ONLY)
+# what a stop order turns into when it triggers
+TRIGGERED_TYPES = {STOP: MARKET, STOP_LIMIT: LIMIT}
+# Limit and post-only orders can be icebergs: given a display quantity they
+# rest showing at most that much, and each time the shown clip fills the
+# next one is shown from the hidden reserve, behind its price level.
+
+# Self-trade prevention: what happens when an order would trade against a
+# resting order of the same owner. The resting order is cancelled and the
+# sweep goes on, the rest of the incoming order is cancelled, or both are
+# reduced by the quantity that would have traded, with no trade.
+CANCEL_RESTING = 'cancel_resting'
+CANCEL_AGGRESSOR = 'cancel_aggressor'
+DECREMENT = 'decrement'
+SELF_TRADE_MODES = (CANCEL_RESTING, CANCEL_AGGRESSOR, DECREMENT)
+
+# Orders that can rest (limit, post-only, stop and stop-limit) can expire:
+# good-till-time orders at an expire_at on the wall clock
+# (time.time_ns(), see expireOrders()) and day orders, placed with
+# expire_at=DAY, at the next endOfDay(). expire_at is journaled and
+# snapshotted, so it is a wall-clock time that still means the same after
+# a restart, unlike the monotonic order timestamps.
+DAY = -1
+
+
+def orderExpiry(order_type, expire_at):
+    """`expire_at` checked against `order_type`."""
+    if expire_at is not None and order_type not in RESTING_TYPES and order_type not in TRIGGERED_TYPES:
+        raise ValueError(f"A {order_type} order cannot have an expiry")
+    return expire_at
+
+
+def icebergDisplay(order_type, quantity, display):
+    """The clip size (lots) to store for an order placed with `display`, None if it is not an iceberg."""
+    if display is None:
+        return None
+    if order_type not in RESTING_TYPES:
+        raise ValueError(f"A {order_type} order cannot have a display quantity")
+    if display <= 0:
+        raise ValueError(f"Display quantity must be positive, got {display}")
+    return display if display < quantity else None
+
+
+# Columns of a placeOrders() batch, in the order journal place records and
+# the shard router's place commands carry them. A batch without order_id
+# and timestamp (NEW_ORDER_COLUMNS) gets generated ones.
+BATCH_COLUMNS = ('order_id', 'instrument', 'side', 'price', 'quantity', 'timestamp', 'owner', 'order_type',
+                 'stop_price', 'display_quantity', 'expire_at')
+NEW_ORDER_COLUMNS = tuple(name for name in BATCH_COLUMNS if name not in ('order_id', 'timestamp'))
+
+
+def newBatch(columns=BATCH_COLUMNS):
+    """Empty placeOrders() batch of `columns`, one list each."""
+    return {name: [] for name in columns}
+
+
+# tick prices that let a market order cross every level; it never rests at them
+MARKET_PRICES = {'buy': (1 << 63) - 1, 'sell': -(1 << 63)}
+
+
+def eventPrice(order):
+    """The price events report for `order`; None for market and stop orders, priced at a MARKET_PRICES sentinel."""
+    return None if order.order_type == MARKET or order.order_type == STOP else order.price
+
+
+class InstrumentSpec:
+    """Tick and lot size of an instrument.
+
+    Orders, trades and acks carry price as an integer number of ticks and
+    quantity as an integer number of lots, so matching is pure integer
+    arithmetic. Decimal prices and quantities only exist at the API edges.
+    """
+
+    def __init__(self, tick_size='0.01', lot_size='0.0001'):
+        self.tick_size = Decimal(str(tick_size))
+        self.lot_size = Decimal(str(lot_size))
+
+    def toTicks(self, price):
+        ticks = Decimal(str(price)) / self.tick_size
+        if ticks != ticks.to_integral_value():
+            raise ValueError(f"Price {price} is not a multiple of the tick size {self.tick_size}")
+        return int(ticks)
+
+    def toLots(self, quantity):
+        lots = Decimal(str(quantity)) / self.lot_size
+        if lots != lots.to_integral_value():
+            raise ValueError(f"Quantity {quantity} is not a multiple of the lot size {self.lot_size}")
+        return int(lots)
+
+    def fromTicks(self, ticks):
+        return ticks * self.tick_size
+
+    def fromLots(self, lots):
+        return lots * self.lot_size
+
+
+class Sequencer:
+    """Monotonic 64-bit sequence numbers for order ids.
+
+    Order ids are plain integers. A UUID is only built when a caller asks for
+    one: the session's random high 64 bits joined with the order id, so it
+    converts back without any lookup table.
+    """
+
+    def __init__(self, start=1, session=None):
+        self.last = start - 1
+        self.session = session if session is not None else uuid.uuid4().int >> 64
+
+    def next(self):
+        self.last += 1
+        return self.last
+
+    def toUuid(self, order_id):
+        return uuid.UUID(int=(self.session << 64) | order_id)
+
+    def fromUuid(self, value):
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(str(value))
+        if value.int >> 64 != self.session:
+            raise ValueError(f"{value} was not issued by this engine")
+        return value.int & 0xFFFFFFFFFFFFFFFF
 
 
 class Order:
-    def __init__(self, instrument, order_id, side, price, quantity, timestamp):
+    __slots__ = ('instrument', 'order_id', 'side', 'price', 'quantity', 'timestamp', 'filled_quantity', 'seq',
+                 'owner', 'order_type', 'stop_price', 'display', 'hidden', 'expire_at')
+
+    # timestamp is the time.monotonic_ns() receive time; seq is the time
+    # priority its book gave it when it was last queued; owner is
+    # the account or session (a str) that placed the order, if any;
+    # stop_price (ticks) is set for stop and stop-limit orders; display
+    # (lots) is an iceberg's clip size, and once it rests `quantity` is the
+    # shown clip and `hidden` the reserve behind it; expire_at is the
+    # time.time_ns() a good-till-time order expires at, or DAY
+    def __init__(self, instrument, order_id, side, price, quantity, timestamp, owner=None,
+                 order_type=LIMIT, stop_price=None, display=None, expire_at=None):
         self.instrument = instrument
         self.order_id = order_id
         self.side = side
@@ -15,47 +176,360 @@ class Order:
         self.quantity = quantity
         self.timestamp = timestamp
         self.filled_quantity = 0
+        self.seq = 0
+        self.owner = owner
+        self.order_type = order_type
+        self.stop_price = stop_price
+        self.display = display
+        self.hidden = 0
+        self.expire_at = expire_at
 
     # price/time priority
     def __lt__(self, other):
         if self.side == 'buy':
-            return (self.price, -self.timestamp) > (other.price, -other.timestamp)  # to get most recent buy order
+            return (self.price, -self.seq) > (other.price, -other.seq)
         else:
-            return (self.price, self.timestamp) < (other.price, other.timestamp)
+            return (self.price, self.seq) < (other.price, other.seq)
 
 
-class OrderBook:
+class LevelDepth:
+    """Total resting quantity per price level for one side of a book.
+
+    Prices are kept sorted with the best level last, so the best level and
+    the top N levels are read without scanning or copying the book.
+    """
+
+    def __init__(self, sign):
+        self.sign = sign  # 1 for bids, -1 for asks
+        self.keys = []
+        self.sizes = {}
+
+    def apply(self, price, delta):
+        sizes = self.sizes
+        size = sizes.get(price, 0) + delta
+        if size:
+            if price not in sizes:
+                bisect.insort(self.keys, self.sign * price)
+            sizes[price] = size
+        else:
+            del sizes[price]
+            key = self.sign * price
+            if self.keys[-1] == key:
+                self.keys.pop()
+            else:
+                del self.keys[bisect.bisect_left(self.keys, key)]
+        return size
+
+    def best(self):
+        if not self.keys:
+            return None, 0
+        price = self.sign * self.keys[-1]
+        return price, self.sizes[price]
+
+    def available(self, price, quantity):
+        """Whether at least `quantity` rests at `price` or better for an order trading against this side."""
+        limit = self.sign * price
+        sizes = self.sizes
+        total = 0
+        for key in reversed(self.keys):
+            if key < limit:
+                return False
+            total += sizes[self.sign * key]
+            if total >= quantity:
+                return True
+        return False
+
+    def levels(self, n=None):
+        sign = self.sign
+        sizes = self.sizes
+        keys = self.keys if n is None else self.keys[-n:]
+        return [(sign * key, sizes[sign * key]) for key in reversed(keys)]
+
+
+class StopSide:
+    """Untriggered stops of one side, by stop price.
+
+    Keys are sign * stop price sorted ascending, with sign chosen so that
+    the stops a trade at some price triggers are always a suffix of the
+    keys: buy stops (sign -1) trigger at or above their stop price, sell
+    stops (sign 1) at or below. Each level is an OrderedDict of
+    order_id -> Order in arrival order.
+    """
+
+    def __init__(self, sign):
+        self.sign = sign
+        self.keys = []
+        self.levels = {}
+        self.count = 0
+
+    def add(self, order):
+        key = self.sign * order.stop_price
+        level = self.levels.get(key)
+        if level is None:
+            level = self.levels[key] = OrderedDict()
+            bisect.insort(self.keys, key)
+        level[order.order_id] = order
+        self.count += 1
+
+    def remove(self, order):
+        key = self.sign * order.stop_price
+        level = self.levels[key]
+        del level[order.order_id]
+        self.count -= 1
+        if not level:
+            del self.levels[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def release(self, price, triggered):
+        """Move the stops a trade at `price` triggers onto `triggered`, nearest stop price first."""
+        keys = self.keys
+        limit = self.sign * price
+        if not keys or keys[-1] < limit:
+            return
+        start = bisect.bisect_left(keys, limit)
+        levels = self.levels
+        for key in reversed(keys[start:]):
+            level = levels.pop(key)
+            self.count -= len(level)
+            triggered.extend(level.values())
+        del keys[start:]
+
+    def __iter__(self):
+        for key in reversed(self.keys):
+            yield from self.levels[key].values()
+
+
+class StopBook:
+    """Stop and stop-limit orders of one instrument waiting for their trigger.
+
+    release() is called with the price of every trade and costs one bisect
+    per side plus the stops it triggers, O(log n + k).
+    """
+
     def __init__(self):
+        self.buys = StopSide(-1)
+        self.sells = StopSide(1)
+
+    def add(self, order):
+        (self.buys if order.side == 'buy' else self.sells).add(order)
+
+    def remove(self, order):
+        (self.buys if order.side == 'buy' else self.sells).remove(order)
+
+    def release(self, price, triggered):
+        self.buys.release(price, triggered)
+        self.sells.release(price, triggered)
+
+    def __len__(self):
+        return self.buys.count + self.sells.count
+
+    def orders(self):
+        """Waiting stops, buys then sells, each in the order they would trigger."""
+        return list(self.buys) + list(self.sells)
+
+
+class OrderBook:
+    def __init__(self, lazy=False, compaction_threshold=0.5):
         self.bids = []
         self.asks = []
+        self.bidDepth = LevelDepth(1)
+        self.askDepth = LevelDepth(-1)
+        # Time priority is this book's own counter: every order queued here,
+        # new or re-queued (iceberg refill, triggered stop, amend), takes the
+        # next seq. It depends only on the order of the book's own commands,
+        # so replay and shard workers rebuild it exactly.
+        self.lastSeq = 0
+
+        # Lazy mode: remove() only drops the order from `live`, leaving its heap
+        # entry behind as a tombstone. bestBid/bestAsk pop tombstones off the top
+        # as they surface, and a side is rebuilt once its tombstones exceed
+        # compaction_threshold of its entries.
+        self.lazy = lazy
+        self.compaction_threshold = compaction_threshold
+        self.live = {}
+        self.liveBids = 0
+        self.liveAsks = 0
+        self.heapifies = 0
+        self.compactions = 0
+        self.compactionTime = 0.0
+        self.lastCompactionTime = 0.0
+
+        # listener(order, delta) is called whenever resting quantity at the
+        # order's price level changes by delta (see marketData)
+        self.listener = None
 
     def add(self, order):
+        self.lastSeq += 1
+        order.seq = self.lastSeq
         if order.side == 'buy':
-            heapq.heappush(self.bids, (-order.price, order.timestamp, order))
+            entry = (-order.price, order.seq, order)
+            heapq.heappush(self.bids, entry)
+            if self.lazy:
+                self.live[order] = entry
+                self.liveBids += 1
         elif order.side == 'sell':
-            heapq.heappush(self.asks, (order.price, order.timestamp, order))
+            entry = (order.price, order.seq, order)
+            heapq.heappush(self.asks, entry)
+            if self.lazy:
+                self.live[order] = entry
+                self.liveAsks += 1
+        else:
+            return
+        self.levelChanged(order, order.quantity)
+
+    def fill(self, order, quantity):
+        """Take `quantity` off a resting order, removing it once nothing is left."""
+        order.quantity -= quantity
+        order.filled_quantity += quantity
+        self.levelChanged(order, -quantity)
+        if order.quantity == 0:
+            self.remove(order)
+
+    def reduce(self, order, quantity):
+        """Take `quantity` off a resting order in place; it keeps its time priority."""
+        order.quantity -= quantity
+        self.levelChanged(order, -quantity)
+
+    def levelChanged(self, order, delta):
+        if not delta:
+            return
+        if order.side == 'buy':
+            self.bidDepth.apply(order.price, delta)
+        else:
+            self.askDepth.apply(order.price, delta)
+        if self.listener is not None:
+            self.listener(order, delta)
+
+    def depth(self, n=None):
+        """Top `n` (default all) levels per side as (price, total quantity), best first."""
+        return self.bidDepth.levels(n), self.askDepth.levels(n)
+
+    def levelSize(self, side, price):
+        return (self.bidDepth if side == 'buy' else self.askDepth).sizes.get(price, 0)
+
+    def topOfBook(self):
+        """(best bid price, size at it, best ask price, size at it); prices are None when a side is empty."""
+        return self.bidDepth.best() + self.askDepth.best()
+
+    def crossing(self, side, price):
+        """The price levels an incoming `side` order limited at `price` trades against, best first, each a list
+        of its resting orders in time priority."""
+        if side == 'buy':
+            heap, limit = self.asks, price
+        else:
+            heap, limit = self.bids, -price
+        live = self.live if self.lazy else None
+        levels = []
+        for key, _, order in sorted(entry for entry in heap
+                                    if entry[0] <= limit and (live is None or live.get(entry[2]) is entry)):
+            if not levels or levels[-1][0].price != order.price:
+                levels.append([])
+            levels[-1].append(order)
+        return levels
 
     def remove(self, order):
-        if order.side == 'buy':
-            self.bids.remove((-order.price, order.timestamp, order))
+        self.levelChanged(order, -order.quantity)
+        if self.lazy:
+            del self.live[order]
+            if order.side == 'buy':
+                self.liveBids -= 1
+                if len(self.bids) - self.liveBids > self.compaction_threshold * len(self.bids):
+                    self.compact()
+            else:
+                self.liveAsks -= 1
+                if len(self.asks) - self.liveAsks > self.compaction_threshold * len(self.asks):
+                    self.compact()
+        elif order.side == 'buy':
+            self.bids.remove((-order.price, order.seq, order))
             heapq.heapify(self.bids)
+            self.heapifies += 1
         else:
-            self.asks.remove((order.price, order.timestamp, order))
+            self.asks.remove((order.price, order.seq, order))
             heapq.heapify(self.asks)
+            self.heapifies += 1
+
+    def removeMany(self, orders):
+        """Remove several resting orders at once, rebuilding each affected heap a single time."""
+        bids = asks = False
+        for order in orders:
+            self.levelChanged(order, -order.quantity)
+            if order.side == 'buy':
+                bids = True
+            else:
+                asks = True
+            if self.lazy:
+                del self.live[order]
+                if order.side == 'buy':
+                    self.liveBids -= 1
+                else:
+                    self.liveAsks -= 1
+
+        if self.lazy:
+            if (len(self.bids) - self.liveBids > self.compaction_threshold * len(self.bids)
+                    or len(self.asks) - self.liveAsks > self.compaction_threshold * len(self.asks)):
+                self.compact()
+            return
+        gone = set(orders)
+        if bids:
+            self.bids = [entry for entry in self.bids if entry[2] not in gone]
+            heapq.heapify(self.bids)
+            self.heapifies += 1
+        if asks:
+            self.asks = [entry for entry in self.asks if entry[2] not in gone]
+            heapq.heapify(self.asks)
+            self.heapifies += 1
+
+    def compact(self):
+        # drop every tombstone and rebuild both heaps
+        start = time.perf_counter()
+        live = self.live
+        self.bids = [entry for entry in self.bids if live.get(entry[2]) is entry]
+        self.asks = [entry for entry in self.asks if live.get(entry[2]) is entry]
+        heapq.heapify(self.bids)
+        heapq.heapify(self.asks)
+        self.heapifies += 2
+        self.lastCompactionTime = time.perf_counter() - start
+        self.compactionTime += self.lastCompactionTime
+        self.compactions += 1
+
+    def skipTombstones(self, heap):
+        live = self.live
+        while heap and live.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+
+    def restingOrders(self):
+        """Resting orders in priority order, bids first then asks."""
+        if self.lazy:
+            self.compact()
+        return [entry[2] for entry in sorted(self.bids)] + [entry[2] for entry in sorted(self.asks)]
+
+    def compactionStats(self):
+        return {
+            "bid_tombstones": len(self.bids) - self.liveBids if self.lazy else 0,
+            "ask_tombstones": len(self.asks) - self.liveAsks if self.lazy else 0,
+            "compactions": self.compactions,
+            "compaction_time": self.compactionTime,
+            "last_compaction_time": self.lastCompactionTime,
+        }
 
     def bestBid(self):
+        if self.lazy:
+            self.skipTombstones(self.bids)
         return self.bids[0][2] if self.bids else None
 
     def bestAsk(self):
+        if self.lazy:
+            self.skipTombstones(self.asks)
         return self.asks[0][2] if self.asks else None
 
-    def showBestBidAndAsk(self):
+    def showBestBidAndAsk(self, spec=None):
         best_bid = self.bestBid()
         best_ask = self.bestAsk()
+        spec = spec or InstrumentSpec(1, 1)
 
         if (best_bid is not None and best_bid.quantity > 0):
             print(
-                f"Best Bid: Instrument: {best_bid.instrument}, Price: {best_bid.price}, Quantity: {best_bid.quantity}")
+                f"Best Bid: Instrument: {best_bid.instrument}, Price: {spec.fromTicks(best_bid.price)}, Quantity: {spec.fromLots(best_bid.quantity)}")
             print(
                 "----------------------------------------------------------------------------------------------------")
         else:
@@ -65,7 +539,7 @@ class OrderBook:
 
         if (best_ask is not None and best_ask.quantity > 0):
             print(
-                f"Best Ask: Instrument: {best_ask.instrument}, Price: {best_ask.price}, Quantity: {best_ask.quantity}")
+                f"Best Ask: Instrument: {best_ask.instrument}, Price: {spec.fromTicks(best_ask.price)}, Quantity: {spec.fromLots(best_ask.quantity)}")
             print(
                 "----------------------------------------------------------------------------------------------------")
         else:
@@ -74,59 +548,538 @@ class OrderBook:
                 "----------------------------------------------------------------------------------------------------")
 
 
-class Trade:
-    def __init__(self, id, name, price, volume):
-        self.id = id
-        self.name = name
-        self.price = price
-        self.volume = volume
+class BookSide:
+    """One side of a PriceLevelBook.
+
+    Price keys are kept sorted ascending with the best level last, so the
+    best level is always ``keys[-1]`` and emptying it is a list pop. Each
+    level is an OrderedDict of order_id -> Order, which keeps FIFO time
+    priority and lets any order leave its level in O(1).
+    """
+
+    def __init__(self, sign):
+        self.sign = sign  # 1 for bids (highest best), -1 for asks (lowest best)
+        self.keys = []
+        self.levels = {}
+        self.count = 0
+
+    def add(self, order):
+        key = self.sign * order.price
+        level = self.levels.get(key)
+        if level is None:
+            level = self.levels[key] = OrderedDict()
+            bisect.insort(self.keys, key)
+        level[order.order_id] = order
+        self.count += 1
+
+    def remove(self, order):
+        key = self.sign * order.price
+        level = self.levels[key]
+        del level[order.order_id]
+        self.count -= 1
+        if not level:
+            del self.levels[key]
+            if self.keys[-1] == key:
+                self.keys.pop()
+            else:
+                del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def best(self):
+        if not self.keys:
+            return None
+        return next(iter(self.levels[self.keys[-1]].values()))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # orders in priority order: best price first, FIFO within a level
+        for key in reversed(self.keys):
+            yield from self.levels[key].values()
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PriceLevelBook(OrderBook):
+    """Order book keyed by price level instead of a single heap per side.
+
+    Drop-in for OrderBook: add/remove/bestBid/bestAsk behave the same, but
+    removing a resting order (cancel or full fill) is O(1) within its level
+    plus O(log levels) when the level empties, instead of list.remove plus
+    a full heapify.
+    """
+
+    lazy = False
+    heapifies = 0
+
+    def __init__(self):
+        self.bids = BookSide(1)
+        self.asks = BookSide(-1)
+        self.bidDepth = LevelDepth(1)
+        self.askDepth = LevelDepth(-1)
+        self.orders = {}
+        self.listener = None
+        self.lastSeq = 0
+
+    def add(self, order):
+        self.lastSeq += 1
+        order.seq = self.lastSeq
+        if order.side == 'buy':
+            self.bids.add(order)
+        elif order.side == 'sell':
+            self.asks.add(order)
+        else:
+            return
+        self.orders[order.order_id] = order
+        self.levelChanged(order, order.quantity)
+
+    def remove(self, order):
+        self.levelChanged(order, -order.quantity)
+        if order.side == 'buy':
+            self.bids.remove(order)
+        else:
+            self.asks.remove(order)
+        del self.orders[order.order_id]
+
+    def removeMany(self, orders):
+        # every order leaves its level in O(1), so there is nothing to batch
+        for order in orders:
+            self.remove(order)
+
+    def get(self, order_id):
+        return self.orders.get(order_id)
+
+    def crossing(self, side, price):
+        opposite = self.asks if side == 'buy' else self.bids
+        limit = opposite.sign * price
+        levels = []
+        for key in reversed(opposite.keys):
+            if key < limit:
+                break
+            levels.append(list(opposite.levels[key].values()))
+        return levels
+
+    def restingOrders(self):
+        return list(self.bids) + list(self.asks)
+
+    def bestBid(self):
+        return self.bids.best()
+
+    def bestAsk(self):
+        return self.asks.best()
+
+
+class OrderBooks(defaultdict):
+    """instrument -> book, creating books with book_factory on first use.
+
+    Every new book gets `listener` installed, so an engine-wide observer
+    such as the market data publisher sees every book. After a snapshot
+    restore, `loader` fills a book from the snapshot when it is first used.
+    """
+
+    def __init__(self, book_factory, listener=None):
+        super().__init__(book_factory)
+        self.listeners = []
+        self.listener = None
+        self.loader = None
+        if listener is not None:
+            self.addListener(listener)
+
+    def addListener(self, listener):
+        """Call `listener(order, delta)` from every book, existing and future, next to earlier listeners."""
+        self.listeners.append(listener)
+        if len(self.listeners) == 1:
+            self.listener = listener
+        else:
+            listeners = tuple(self.listeners)
+
+            def fanout(order, delta):
+                for listener in listeners:
+                    listener(order, delta)
+            self.listener = fanout
+        for book in self.values():
+            book.listener = self.listener
+
+    def __missing__(self, instrument):
+        book = super().__missing__(instrument)
+        book.listener = self.listener
+        if self.loader is not None:
+            self.loader.materialize(instrument, book)
+        return book
 
 
 class MatchedOrder:
-    def __init__(self, order_id, side, price, filled_quantity, instrument, timestamp):
+    __slots__ = ('order_id', 'side', 'price', 'filled_quantity', 'instrument', 'timestamp', 'owner')
+
+    def __init__(self, order_id, side, price, filled_quantity, instrument, timestamp, owner=None):
         self.order_id = order_id
         self.side = side
         self.price = price
         self.filled_quantity = filled_quantity
         self.instrument = instrument
         self.timestamp = timestamp
+        self.owner = owner
 
 
 class MatchingEngine:
-    def __init__(self):
-        self.orderbooks = defaultdict(OrderBook)
-        self.trades = defaultdict(list)
-        self.buyerAckQueue = []
-        self.sellerAckQueue = []
+    # book_factory builds the book for each new instrument, e.g. PriceLevelBook
+    # or functools.partial(OrderBook, lazy=True)
+    # sink receives every accepted/fill/cancel/reject event; pass e.g.
+    # events.RingBufferSink() to run without console output
+    # ack queues are bounded rings; consumers read them through
+    # buyerAckQueue.cursor(name) / sellerAckQueue.cursor(name), and acks are
+    # published once the command that made them is done, see publishAcks()
+    # prices and quantities are stored as integer ticks/lots, see
+    # configureInstrument(); unconfigured instruments use default_spec
+    # order ids come from sequencer; orderUuid() turns one into a UUID
+    # journal_path write-ahead logs every command, see openJournal()
+    # trades keeps the last trade_retention trades per instrument in memory,
+    # spilling older ones to spill_dir if given, with OHLCV bars for each of
+    # bar_intervals (ns); see tradeTape.TradeTape
+    # self_trade is one of SELF_TRADE_MODES, or None to let an owner's
+    # orders trade with each other; replay must use the same mode
+    def __init__(self, book_factory=OrderBook, sink=None, ack_capacity=65536, default_spec=None, sequencer=None,
+                 journal_path=None, trade_retention=100000, spill_dir=None, bar_intervals=(), self_trade=None):
+        if self_trade is not None and self_trade not in SELF_TRADE_MODES:
+            raise ValueError(f"Unknown self-trade prevention mode {self_trade!r}")
+        self.self_trade = self_trade
+        self.orderbooks = OrderBooks(book_factory)
+        self.sequencer = sequencer or Sequencer()
+        self.journal = None
+        self.instruments = {}
+        self.default_spec = default_spec or InstrumentSpec()
+        self.sink = sink if sink is not None else events.ConsoleSink(self.spec)
+        self.trades = TradeTapes(trade_retention, spill_dir, bar_intervals)
+        self.buyerAckQueue = RingBuffer(ack_capacity)
+        self.sellerAckQueue = RingBuffer(ack_capacity)
+        self.pendingAcks = []
         self.orders = {}
-
-    def placeOrder(self, instrument, side, price, quantity):
-        order = Order(instrument, uuid.uuid1(), side, price, quantity, timestamp=int(time.time()))
-        self.processOrder(order)
-        self.orders[order.order_id] = order
+        # owner -> {order_id: order} of that owner's resting orders, for cancelAll
+        self.ownerOrders = defaultdict(dict)
+        # instrument -> StopBook of untriggered stop orders, and the stops
+        # triggered by the trades of the order being matched, run in turn
+        self.stopBooks = {}
+        self.triggered = deque()
+        self.releasing = False
+        # (expire_at, order_id, order) heap of good-till-time orders and the
+        # day orders placed since the last endOfDay(); cancelled and filled
+        # orders are skipped when their turn comes rather than removed
+        self.expiries = []
+        self.dayOrders = {}
+        # set by from_snapshot(): books and orders still waiting in the snapshot file
+        self.snapshotLoader = None
+        self.instrumentation = None
+        # pre-trade checks, see enableRiskChecks()
+        self.risk = None
+        if journal_path is not None:
+            self.openJournal(journal_path)
+
+    def snapshot(self, path):
+        """Write every resting order, instrument spec and the sequencer position to `path`."""
+        snapshot.writeSnapshot(self, path)
+
+    @classmethod
+    def from_snapshot(cls, path, **engine_kwargs):
+        """Engine restored from snapshot(); see snapshot.loadSnapshot."""
+        return snapshot.loadSnapshot(path, **engine_kwargs)
+
+    def lookupOrder(self, order_id):
+        order = self.orders.get(order_id)
+        if order is None and self.snapshotLoader is not None:
+            order = self.snapshotLoader.lookup(order_id)
+        return order
+
+    def openJournal(self, path, **sync_options):
+        """Start write-ahead journaling every command that changes the engine's state.
+
+        The journal is tied to this engine's sequencer session; reopen an
+        existing journal with the engine journal.replay() rebuilt from it.
+        placeOrders() flushes it after every batch; callers driving the
+        engine through single commands call journal.flush() before they
+        acknowledge them.
+        """
+        self.journal = journal.Journal(path, self.sequencer.session, **sync_options)
+
+    def enableInstrumentation(self, dump_interval=None, dump=None):
+        """Start recording latency histograms and counters for the hot paths.
+
+        The timed methods are shadowed by wrappers on this instance only, so
+        an engine without instrumentation runs the plain methods. With
+        `dump_interval` seconds, dump(stats()) is called periodically
+        (JSON on stderr by default).
+        """
+        self.disableInstrumentation()
+        self.instrumentation = instrumentation.Instrumentation(dump_interval, dump)
+        for name, instrument_of in instrumentation.TIMED.items():
+            setattr(self, name, self.instrumentation.timed(self, name, getattr(self, name), instrument_of))
+        return self.instrumentation
+
+    def disableInstrumentation(self):
+        if self.instrumentation is None:
+            return
+        for name in instrumentation.TIMED:
+            vars(self).pop(name, None)
+        self.instrumentation = None
+
+    def enableRiskChecks(self, **limits):
+        """Run every new order and re-queueing amend through a risk.RiskCheck with `limits` first.
+
+        Rejected orders get a REJECT event and are neither journaled nor
+        matched, so journal replay never needs the limits.
+        """
+        self.risk = risk.RiskCheck(self, **limits)
+        return self.risk
+
+    def riskReject(self, order, reason):
+        self.sink.emit(Event(events.REJECT, order.order_id, order.instrument, order.side, eventPrice(order),
+                             order.quantity, 0, order.timestamp, reason))
+
+    def stats(self):
+        """Book sizes and heapify counts, plus latencies (ns) and counters while instrumented."""
+        books = {}
+        for instrument, book in self.orderbooks.items():
+            entry = {"bid_levels": len(book.bidDepth.sizes), "ask_levels": len(book.askDepth.sizes),
+                     "heapify_calls": book.heapifies}
+            if not isinstance(book, PriceLevelBook):
+                entry["heap_size"] = len(book.bids) + len(book.asks)
+            books[instrument] = entry
+        stats = {"books": books}
+        if self.instrumentation is not None:
+            stats["latency"] = self.instrumentation.latency()
+            stats["counters"] = dict(self.instrumentation.counters,
+                                     heapify_calls=sum(entry["heapify_calls"] for entry in books.values()))
+        return stats
+
+    def configureInstrument(self, instrument, tick_size, lot_size):
+        if instrument in self.orderbooks:
+            raise ValueError(f"Cannot change tick/lot size of {instrument} once it has orders")
+        self.instruments[instrument] = InstrumentSpec(tick_size, lot_size)
+        if self.journal is not None:
+            self.journal.logConfigure(instrument, tick_size, lot_size)
+
+    def spec(self, instrument):
+        return self.instruments.get(instrument, self.default_spec)
+
+    def placeOrder(self, instrument, side, price, quantity, owner=None, order_type=LIMIT, stop_price=None,
+                   display_quantity=None, expire_at=None):
+        """Place an order of one of ORDER_TYPES.
+
+        `price` is ignored (and may be None) for market and stop orders;
+        stop and stop-limit orders need a `stop_price`. A limit or
+        post-only order with a `display_quantity` below its quantity is an
+        iceberg. An order that can rest is cancelled at `expire_at`, see DAY.
+        """
+        if order_type not in ORDER_TYPES:
+            raise ValueError(f"Unknown order type {order_type!r}")
+        self.checkAcks()
+        spec = self.spec(instrument)
+        price = MARKET_PRICES[side] if order_type in (MARKET, STOP) else spec.toTicks(price)
+        if order_type in TRIGGERED_TYPES:
+            if stop_price is None:
+                raise ValueError(f"A {order_type} order needs a stop price")
+            stop_price = spec.toTicks(stop_price)
+        else:
+            stop_price = None
+        quantity = spec.toLots(quantity)
+        if display_quantity is not None:
+            display_quantity = icebergDisplay(order_type, quantity, spec.toLots(display_quantity))
+        order = Order(instrument, self.sequencer.next(), side, price, quantity, time.monotonic_ns(), owner=owner,
+                      order_type=order_type, stop_price=stop_price, display=display_quantity,
+                      expire_at=orderExpiry(order_type, expire_at))
+        if self.risk is not None:
+            reason = self.risk.check(order)
+            if reason is not None:
+                self.riskReject(order, reason)
+                return order.order_id
+        if self.journal is not None:
+            self.journal.logPlace(order)
+        if self.processOrder(order):
+            if owner is not None and order.quantity:
+                self.ownerOrders[owner][order.order_id] = order
+            if order.expire_at is not None and order.quantity:
+                self.scheduleExpiry(order)
         return order.order_id
 
+    def placeOrders(self, batch, scaled=False):
+        """Place a columnar batch of orders.
+
+        `batch` maps 'instrument', 'side', 'price' and 'quantity' to parallel
+        sequences; a NumPy structured array with those fields works as is.
+        Prices and quantities are decimals unless `scaled` is set, in which
+        case they are already integer ticks and lots. Optional 'order_id'
+        and 'timestamp' columns replace the generated ones (used by journal
+        replay and shard workers), and optional 'owner', 'order_type', 'stop_price',
+        'display_quantity' and 'expire_at' columns set each order's owner,
+        type, stop price, iceberg clip size and expiry (market and stop
+        orders may have a price of None; None means no stop price, clip or
+        expiry).
+        Every row is converted and checked before any is placed, so a batch
+        with a bad row raises ValueError without placing, journaling or
+        matching any of it.
+        Rows are grouped by instrument and each group is matched in arrival order against its
+        book, sharing one timestamp and one book lookup. Rows with given ids
+        are applied strictly in arrival order, only runs of consecutive rows
+        for one instrument sharing a lookup, so a replay does exactly what
+        the original run did.
+
+        Returns (order_ids, fills): order_ids[i] is the id of row i, and fills
+        holds parallel 'index', 'order_id', 'price' and 'quantity' columns, one
+        entry per trade, where index is the row of the aggressing order and
+        price/quantity are in ticks/lots. NumPy input gets NumPy arrays back.
+        """
+        self.checkAcks()
+        is_numpy = np is not None and isinstance(batch, np.ndarray)
+        names = batch.dtype.names if is_numpy else batch.keys()
+
+        def column(name, required=False):
+            # the column as a list (NumPy columns are converted once), None if an optional one is missing
+            if not required and name not in names:
+                return None
+            values = batch[name]
+            return values.tolist() if hasattr(values, 'tolist') else values
+
+        instruments, sides, prices, quantities = (column(name, True)
+                                                  for name in ('instrument', 'side', 'price', 'quantity'))
+        given_ids = column('order_id')
+        given_timestamps = None if given_ids is None else column('timestamp', True)
+        owners = column('owner')
+        order_types = column('order_type')
+        stop_prices = column('stop_price')
+        displays = column('display_quantity')
+        expiries = column('expire_at')
+
+        specs = {}
+        converted = []
+        for row, instrument in enumerate(instruments):
+            spec = specs.get(instrument)
+            if spec is None:
+                spec = specs[instrument] = self.spec(instrument)
+            side = sides[row]
+            if side not in MARKET_PRICES:
+                raise ValueError(f"Unknown side {side!r}")
+            order_type = LIMIT if order_types is None else order_types[row]
+            if order_type not in ORDER_TYPES:
+                raise ValueError(f"Unknown order type {order_type!r}")
+            stop_price = None
+            if order_type in TRIGGERED_TYPES:
+                if stop_prices is None or stop_prices[row] is None:
+                    raise ValueError(f"A {order_type} order needs a stop price")
+                stop_price = stop_prices[row] if scaled else spec.toTicks(stop_prices[row])
+            if order_type == MARKET or order_type == STOP:
+                price = MARKET_PRICES[side]
+                quantity = quantities[row] if scaled else spec.toLots(quantities[row])
+            elif scaled:
+                price, quantity = prices[row], quantities[row]
+            else:
+                price, quantity = spec.toTicks(prices[row]), spec.toLots(quantities[row])
+            display = None
+            if displays is not None and displays[row] is not None:
+                display = icebergDisplay(order_type, quantity, displays[row] if scaled else spec.toLots(displays[row]))
+            expire_at = None if expiries is None else orderExpiry(order_type, expiries[row])
+            converted.append((price, quantity, order_type, stop_price, display, expire_at))
+
+        if given_ids is None:
+            groups = defaultdict(list)
+            for row, instrument in enumerate(instruments):
+                groups[instrument].append(row)
+            groups = groups.items()
+        else:
+            groups = []
+            for row, instrument in enumerate(instruments):
+                if groups and groups[-1][0] == instrument:
+                    groups[-1][1].append(row)
+                else:
+                    groups.append((instrument, [row]))
+
+        next_id = self.sequencer.next
+        timestamp = time.monotonic_ns()
+        journal = self.journal
+        order_ids = [None] * len(instruments)
+        fills = {"index": [], "order_id": [], "price": [], "quantity": []}
+        fill_index = fills["index"]
+        fill_ids = fills["order_id"]
+        fill_prices = fills["price"]
+        fill_quantities = fills["quantity"]
+
+        for instrument, rows in groups:
+            orderbook = self.orderbooks[instrument]
+            trades = self.trades[instrument]
+            for row in rows:
+                price, quantity, order_type, stop_price, display, expire_at = converted[row]
+                owner = None if owners is None else owners[row]
+                if given_ids is None:
+                    order = Order(instrument, next_id(), sides[row], price, quantity, timestamp, owner=owner,
+                                  order_type=order_type, stop_price=stop_price, display=display,
+                                  expire_at=expire_at)
+                else:
+                    order = Order(instrument, given_ids[row], sides[row], price, quantity, given_timestamps[row],
+                                  owner=owner, order_type=order_type, stop_price=stop_price, display=display,
+                                  expire_at=expire_at)
+                order_ids[row] = order.order_id
+                if self.risk is not None:
+                    reason = self.risk.check(order)
+                    if reason is not None:
+                        self.riskReject(order, reason)
+                        continue
+                if journal is not None:
+                    journal.logPlace(order)
+                last_trade = trades.seq
+                if self.processOrder(order, orderbook):
+                    if owner is not None and order.quantity:
+                        self.ownerOrders[owner][order.order_id] = order
+                    if expire_at is not None and order.quantity:
+                        self.scheduleExpiry(order)
+                if trades.seq == last_trade:
+                    continue
+                for trade in trades.trades(last_trade + 1):
+                    fill_index.append(row)
+                    fill_ids.append(trade.id)
+                    fill_prices.append(trade.price)
+                    fill_quantities.append(trade.volume)
+
+        if journal is not None:
+            # the batch is durable before the caller sees its results
+            journal.flush()
+
+        if is_numpy:
+            order_ids = np.array(order_ids, dtype=object)
+            fills = {"index": np.array(fill_index, dtype=np.int64),
+                     "order_id": np.array(fill_ids, dtype=object),
+                     "price": np.array(fill_prices),
+                     "quantity": np.array(fill_quantities)}
+        return order_ids, fills
+
     # Change the code to show order instrument,quantity,timestamp
     def getOrderBook(self, instrument):
         orderbook = self.orderbooks[instrument]
         # orderbook.showBestBidAndAsk()
+        if orderbook.lazy:
+            # don't hand tombstones to callers
+            orderbook.compact()
         return orderbook.bids, orderbook.asks
 
     def showBestBidAsk(self, instrument):
         orderbook = self.orderbooks[instrument]
-        orderbook.showBestBidAndAsk()
+        orderbook.showBestBidAndAsk(self.spec(instrument))
+
+    def getTrades(self, instrument, start=None, stop=None):
+        """Trades of `instrument` with start <= seq < stop; by default the ones still in memory."""
+        return list(self.trades[instrument].trades(start, stop))
 
-    def getTrades(self, instrument):
-        return self.trades[instrument]
+    def getBars(self, instrument, interval):
+        """OHLCV bars of `instrument` for one of the engine's bar_intervals, oldest first."""
+        return self.trades[instrument].bars[interval].bars()
 
-    def showTrades(self, instrument):
-        trade_obj = self.getTrades(instrument)
+    def showTrades(self, instrument, start=None, stop=None):
+        trade_obj = self.getTrades(instrument, start, stop)
+        spec = self.spec(instrument)
         for i in trade_obj:
             trade_details = {
                 "message": f"Trades made for {i.name}",
                 "order_id": f"Order id {i.id}",
-                "price": f"{i.price}",
-                "quantity traded": f"{i.volume}"
+                "price": f"{spec.fromTicks(i.price)}",
+                "quantity traded": f"{spec.fromLots(i.volume)}"
             }
 
             # Convert the dictionary to a JSON-formatted string
@@ -135,34 +1088,157 @@ class MatchingEngine:
             # Print the JSON-formatted string
             print(json_data_trade)
 
-    def processOrder(self, order):
-        orderbook = self.orderbooks[order.instrument]
-
-        timestamp = datetime.datetime.fromtimestamp(order.timestamp)
-
-        if (order.side == 'buy'):
-            print(f"{timestamp} : Buy order {order.order_id, order.instrument, order.price, order.quantity} is added to orderbook")
-
-
-        else:
-            print(f"{timestamp} : Sale order {order.order_id, order.instrument, order.price, order.quantity} is added to orderbook")
+    def processOrder(self, order, orderbook=None):
+        """Match `order` and rest what is left; returns False if its order type made it a reject.
+
+        A stop order waits in the instrument's StopBook instead. Stops the
+        order's trades trigger are run before this returns, see releaseStops().
+        """
+        if orderbook is None:
+            orderbook = self.orderbooks[order.instrument]
+
+        price = order.price
+        if order.order_type != LIMIT:
+            reason = self.checkOrderType(order, orderbook)
+            if reason is not None:
+                self.sink.emit(Event(events.REJECT, order.order_id, order.instrument, order.side, eventPrice(order),
+                                     order.quantity, 0, order.timestamp, reason))
+                return False
+            price = eventPrice(order)
+
+        self.sink.emit(Event(events.ACCEPTED, order.order_id, order.instrument, order.side, price,
+                             order.quantity, order.filled_quantity, order.timestamp, None))
+        # registered before matching: stops this order triggers may meet it again once it rests
+        self.orders[order.order_id] = order
 
-        if (order.side == 'buy' and orderbook.bestAsk() is not None and order.price >= orderbook.bestAsk().price):
-            # Buy order crossed the spread
+        # the match loops sweep whatever crosses the spread and rest the
+        # remainder, so an order that does not cross goes straight to the book
+        if order.order_type in TRIGGERED_TYPES:
+            self.addStop(order)
+        elif order.side == 'buy':
             self.matchBuyOrder(order, orderbook)
-            # print(f"Buy order {order.order_id,order.instrument,order.price,order.quantity} matched with buy order {orderbook.bestAsk().order_id,orderbook.Ask().price,orderbook.bestAsk().quantity}")
-            # print("----------------------------------------------------------------------------------------------------")
-
-
-        elif (order.side == 'sell' and orderbook.bestBid() is not None and order.price <= orderbook.bestBid().price):
-            # Sell order crossed the spread.
-            qty = order.quantity
+        elif order.side == 'sell':
             self.matchSellOrder(order, orderbook)
-            # print(f"Sale order {order.order_id,order.instrument,order.price,qty} matched with buy order {orderbook.bestBid().order_id,orderbook.bestBid().price,orderbook.bestBid().quantity}")
-            # print("----------------------------------------------------------------------------------------------------")
+        if self.triggered and not self.releasing:
+            self.releaseStops()
+        if self.pendingAcks:
+            self.publishAcks()
+        return True
+
+    def addStop(self, order):
+        stops = self.stopBooks.get(order.instrument)
+        if stops is None:
+            stops = self.stopBooks[order.instrument] = StopBook()
+        stops.add(order)
+        # a stop the last trade already went through triggers right away
+        tape = self.trades.get(order.instrument)
+        if tape is not None and tape.lastPrice is not None:
+            stops.release(tape.lastPrice, self.triggered)
+
+    def releaseStops(self):
+        """Match the triggered stops in trigger order, including any their own trades trigger."""
+        triggered = self.triggered
+        self.releasing = True
+        while triggered:
+            order = triggered.popleft()
+            order.order_type = TRIGGERED_TYPES[order.order_type]
+            self.sink.emit(Event(events.TRIGGERED, order.order_id, order.instrument, order.side, order.stop_price,
+                                 order.quantity, order.filled_quantity, order.timestamp, None))
+            orderbook = self.orderbooks[order.instrument]
+            if order.side == 'buy':
+                self.matchBuyOrder(order, orderbook)
+            else:
+                self.matchSellOrder(order, orderbook)
+            if order.quantity == 0 and order.owner is not None:
+                self.ownerOrders[order.owner].pop(order.order_id, None)
+        self.releasing = False
+
+    def checkOrderType(self, order, orderbook):
+        """Reject reason for a FOK that cannot fill or a post-only order that would trade, else None."""
+        opposite = orderbook.askDepth if order.side == 'buy' else orderbook.bidDepth
+        if order.order_type == FOK:
+            # aggregated depth answers most of these without touching the book; it only counts
+            # shown quantity, and the owner's own orders never fill a FOK under self-trade prevention
+            own = self.self_trade is not None and order.owner is not None and self.ownerOrders.get(order.owner)
+            if (own or not opposite.available(order.price, order.quantity)) and not self.fokFillable(order, orderbook):
+                return events.FOK_UNFILLED
+        elif order.order_type == POST_ONLY:
+            best = opposite.best()[0]
+            if best is not None and (order.price >= best if order.side == 'buy' else order.price <= best):
+                return events.POST_ONLY_CROSSED
+        return None
+
+    def fokFillable(self, order, orderbook):
+        """Whether FOK `order` fills entirely, walking the orders it would meet.
+
+        Decided before anything in the book changes. An iceberg's reserve
+        counts after every clip shown at its level, where its refills queue.
+        Under self-trade prevention an own order met on the way is skipped
+        under CANCEL_RESTING, where the sweep cancels it and goes on, and
+        makes the FOK unfillable under the other modes, where it would cut
+        the FOK short.
+        """
+        prevent = self.self_trade if order.owner is not None else None
+        needed = order.quantity
+        for level in orderbook.crossing(order.side, order.price):
+            reserve = 0
+            for resting in level:
+                if prevent is not None and resting.owner == order.owner:
+                    if prevent != CANCEL_RESTING:
+                        return False
+                    continue
+                needed -= resting.quantity
+                if needed <= 0:
+                    return True
+                reserve += resting.hidden
+            needed -= reserve
+            if needed <= 0:
+                return True
+        return False
+
+    def cancelRemainder(self, order, reason=None):
+        """Cancel what is left of an order that may not rest (market, IOC) or that would self-trade."""
+        self.sink.emit(Event(events.CANCEL, order.order_id, order.instrument, order.side, eventPrice(order),
+                             order.quantity, order.filled_quantity, order.timestamp, reason))
+        order.quantity = 0
+
+    def preventSelfTrade(self, order, resting, orderbook):
+        """Apply the self-trade mode to incoming `order` meeting `resting` of the same owner."""
+        mode = self.self_trade
+        if mode == CANCEL_AGGRESSOR:
+            self.cancelRemainder(order, events.SELF_TRADE)
+            return
+        if mode == CANCEL_RESTING:
+            quantity = resting.quantity + resting.hidden
+        else:
+            quantity = min(order.quantity, resting.quantity)
+        self.sink.emit(Event(events.CANCEL, resting.order_id, resting.instrument, resting.side, resting.price,
+                             quantity, resting.filled_quantity, resting.timestamp, events.SELF_TRADE))
+        if quantity < resting.quantity:
+            orderbook.reduce(resting, quantity)
+        elif mode == DECREMENT and resting.hidden:
+            orderbook.remove(resting)
+            self.replenish(resting, orderbook)
         else:
-            # Order did not cross the spread, place in order book
-            orderbook.add(order)
+            resting.hidden = 0
+            orderbook.remove(resting)
+            del self.orders[resting.order_id]
+            self.ownerOrders[resting.owner].pop(resting.order_id, None)
+            resting.quantity = 0
+        if mode == DECREMENT:
+            order.quantity -= quantity
+            self.sink.emit(Event(events.CANCEL, order.order_id, order.instrument, order.side, eventPrice(order),
+                                 quantity, order.filled_quantity, order.timestamp, events.SELF_TRADE))
+
+    def replenish(self, order, orderbook):
+        """Show the next clip of an iceberg whose shown clip is gone, at the back of its price level."""
+        clip = min(order.display, order.hidden)
+        order.hidden -= clip
+        order.quantity = clip
+        orderbook.add(order)
+
+    def orderUuid(self, order_id):
+        return self.sequencer.toUuid(order_id)
 
     def uuid_serializer(self, obj):
         if isinstance(obj, uuid.UUID):
@@ -170,56 +1246,250 @@ class MatchingEngine:
         raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
 
     def acknowledgeOrder(self, matchedOrder):
-        timeACk = datetime.datetime.fromtimestamp(matchedOrder.timestamp)
-
-        # Store the order details in a dictionary with the "message" key first
-        order_details = {
-            "message": f"Order acknowledgement for {'buy' if matchedOrder.side == 'buy' else 'sell'} order {matchedOrder.order_id, matchedOrder.instrument}",
-            "order_id": matchedOrder.order_id,
-            "instrument": matchedOrder.instrument,
-            "price": matchedOrder.price,
-            "filled_quantity": matchedOrder.filled_quantity,
-            "timestamp": timeACk.isoformat(),
-            "action": "Bought" if matchedOrder.side == "buy" else "Sold",
-        }
-
-        # Convert the dictionary to a JSON-formatted string
-        json_data = json.dumps(order_details, indent=2, default=self.uuid_serializer)
-
-        # Print the JSON-formatted string
-        print(json_data)
-        print("----------------------------------------------------------------------------------------------------")
-
-        if matchedOrder.side == "buy":
-            self.buyerAckQueue.append(matchedOrder)
-        else:
-            self.sellerAckQueue.append(matchedOrder)
+        self.sink.emit(Event(events.FILL, matchedOrder.order_id, matchedOrder.instrument, matchedOrder.side,
+                             matchedOrder.price, matchedOrder.filled_quantity, matchedOrder.filled_quantity,
+                             matchedOrder.timestamp, None))
+        self.pendingAcks.append(matchedOrder)
+
+    def publishAcks(self):
+        """Move the acks queued by matching onto the ack queues, in order.
+
+        The match loops only queue acks, so a full ring can never stop a
+        match halfway. Acks a backpressured consumer has no room for stay
+        queued, and checkAcks() refuses the next order or amend until they
+        are out.
+        """
+        pending = self.pendingAcks
+        published = 0
+        try:
+            for matchedOrder in pending:
+                if matchedOrder.side == "buy":
+                    self.buyerAckQueue.append(matchedOrder)
+                else:
+                    self.sellerAckQueue.append(matchedOrder)
+                published += 1
+        except RingFullError:
+            pass
+        del pending[:published]
+
+    def checkAcks(self):
+        """Raise RingFullError, before anything is journaled or matched, while earlier acks cannot be published."""
+        if self.pendingAcks:
+            self.publishAcks()
+            if self.pendingAcks:
+                raise RingFullError(f"{len(self.pendingAcks)} acks are waiting for a backpressured consumer")
 
     def cancelOrder(self, order_id):
-        if order_id in self.orders:
-            order = self.orders[order_id]
+        if isinstance(order_id, uuid.UUID):
+            order_id = self.sequencer.fromUuid(order_id)
+        if self.journal is not None:
+            self.journal.logCancel(order_id)
+        order = self.lookupOrder(order_id)
+        if order is not None:
             if (order.quantity == 0):
-                print(f"Cannot cancel order {order_id}, already fully filled")
+                self.sink.emit(Event(events.REJECT, order_id, order.instrument, order.side, eventPrice(order),
+                                     0, order.filled_quantity, order.timestamp, events.ALREADY_FILLED))
                 return True
-            elif order.filled_quantity < order.quantity:
-                filled_qty = order.filled_quantity
-                remaining_quantity = order.quantity
-                order.quantity -= order.filled_quantity
-                orderbook = self.orderbooks[order.instrument]
-                orderbook.remove(order)
-                del self.orders[order_id]
-
-                print(
-                    f"Order ID: {order_id} is cancelled. Filled quantity: {filled_qty}, Remaining quantity: {remaining_quantity}")
-
-
             else:
                 orderbook = self.orderbooks[order.instrument]
-                orderbook.remove(order)
+                cancelled = order.quantity + order.hidden
+                order.hidden = 0
+                if order.order_type in TRIGGERED_TYPES:
+                    self.stopBooks[order.instrument].remove(order)
+                else:
+                    orderbook.remove(order)
                 del self.orders[order_id]
-                print(f"Order ID: {order_id} is cancelled")
+                if order.owner is not None:
+                    self.ownerOrders[order.owner].pop(order_id, None)
+                self.sink.emit(Event(events.CANCEL, order_id, order.instrument, order.side, eventPrice(order),
+                                     cancelled, order.filled_quantity, order.timestamp, None))
+        else:
+            self.sink.emit(Event(events.REJECT, order_id, None, None, None, 0, 0, None, events.NO_SUCH_ORDER))
+
+    def amendOrder(self, order_id, new_price=None, new_qty=None, scaled=False):
+        """Change the price and/or remaining quantity of a resting order.
+
+        Lowering the quantity at an unchanged price updates the order in
+        place and keeps its queue position. Any other change takes it off
+        the book and re-queues it behind its new level, matching first if
+        the new price crosses. An iceberg's quantity is its shown clip plus its reserve,
+        and lowering it takes from the reserve first. A stop that has not triggered yet keeps its stop price and
+        gets its limit price and quantity changed in place. A quantity of 0
+        cancels the order. Prices and quantities are decimals unless
+        `scaled` is set. Returns False if rejected.
+        """
+        if isinstance(order_id, uuid.UUID):
+            order_id = self.sequencer.fromUuid(order_id)
+        self.checkAcks()
+        order = self.lookupOrder(order_id)
+        if order is None:
+            self.sink.emit(Event(events.REJECT, order_id, None, None, None, 0, 0, None, events.NO_SUCH_ORDER))
+            return False
+        if order.quantity == 0:
+            self.sink.emit(Event(events.REJECT, order_id, order.instrument, order.side, eventPrice(order),
+                                 0, order.filled_quantity, order.timestamp, events.ALREADY_FILLED))
+            return False
+
+        if not scaled:
+            spec = self.spec(order.instrument)
+            new_price = None if new_price is None else spec.toTicks(new_price)
+            new_qty = None if new_qty is None else spec.toLots(new_qty)
+        parked = order.order_type in TRIGGERED_TYPES
+        price = order.price if new_price is None or order.order_type == STOP else new_price
+        remaining = order.quantity + order.hidden
+        quantity = remaining if new_qty is None else new_qty
+        in_place = parked or (price == order.price and quantity <= remaining)
+        if (parked or not in_place) and self.risk is not None:
+            amended = Order(order.instrument, order_id, order.side, price, quantity, order.timestamp,
+                            owner=order.owner, order_type=order.order_type, stop_price=order.stop_price)
+            # a waiting stop is not part of the owner's resting exposure yet
+            reason = self.risk.check(amended, replaced=None if parked else order)
+            if reason is not None:
+                self.riskReject(amended, reason)
+                return False
+        if self.journal is not None:
+            self.journal.logAmend(order_id, new_price, new_qty)
+
+        if quantity <= 0:
+            self.cancelOrders([order])
+            return True
+        orderbook = self.orderbooks[order.instrument]
+        if parked:
+            order.price = price
+            order.quantity = quantity
+        elif in_place:
+            cut = remaining - quantity
+            from_hidden = min(cut, order.hidden)
+            order.hidden -= from_hidden
+            orderbook.reduce(order, cut - from_hidden)
+            if from_hidden and self.risk is not None:
+                # the book only reports shown quantity
+                self.risk.levelChanged(order, 0)
+        else:
+            order.hidden = 0
+            orderbook.remove(order)
+            order.price = price
+            order.quantity = quantity
+        self.sink.emit(Event(events.AMENDED, order_id, order.instrument, order.side, eventPrice(order), quantity,
+                             order.filled_quantity, order.timestamp, None))
+        if not in_place:
+            if order.side == 'buy':
+                self.matchBuyOrder(order, orderbook)
+            else:
+                self.matchSellOrder(order, orderbook)
+            if order.quantity == 0 and order.owner is not None:
+                self.ownerOrders[order.owner].pop(order_id, None)
+            if self.triggered and not self.releasing:
+                self.releaseStops()
+            if self.pendingAcks:
+                self.publishAcks()
+        return True
+
+    def cancelAll(self, owner):
+        """Cancel every resting order of `owner`; returns the cancelled order ids."""
+        if self.journal is not None:
+            self.journal.logCancelAll(owner)
+        if self.snapshotLoader is not None:
+            self.snapshotLoader.materializeAll()
+        return self.cancelOrders(list(self.ownerOrders.pop(owner, {}).values()))
+
+    def cancelInstrument(self, instrument, side=None):
+        """Cancel every resting and stop order of `instrument`, or only its `side`; returns the cancelled order ids."""
+        if self.journal is not None:
+            self.journal.logCancelInstrument(instrument, side)
+        if instrument not in self.orderbooks and instrument not in getattr(self.snapshotLoader, 'rows', ()):
+            return []
+        orders = self.orderbooks[instrument].restingOrders()
+        stops = self.stopBooks.get(instrument)
+        if stops:
+            orders += stops.orders()
+        if side is not None:
+            orders = [order for order in orders if order.side == side]
+        return self.cancelOrders(orders)
+
+    def cancelSide(self, instrument, side):
+        return self.cancelInstrument(instrument, side)
+
+    def cancelOrders(self, orders, reason=None):
+        """Take resting `orders` off their books together.
+
+        Each book removes its share in one pass (one heap rebuild per side)
+        and the cancel events, carrying `reason`, go to the sink as a single
+        batch.
+        """
+        by_instrument = defaultdict(list)
+        hidden = {}
+        for order in orders:
+            if order.quantity:
+                by_instrument[order.instrument].append(order)
+                if order.hidden:
+                    hidden[order.order_id] = order.hidden
+                    order.hidden = 0
+
+        cancels = []
+        owner_orders = self.ownerOrders
+        for instrument, group in by_instrument.items():
+            stops = self.stopBooks.get(instrument)
+            resting = group
+            if stops:
+                resting = []
+                for order in group:
+                    if order.order_type in TRIGGERED_TYPES:
+                        stops.remove(order)
+                    else:
+                        resting.append(order)
+            self.orderbooks[instrument].removeMany(resting)
+            for order in group:
+                del self.orders[order.order_id]
+                if order.owner is not None and order.owner in owner_orders:
+                    owner_orders[order.owner].pop(order.order_id, None)
+                cancels.append(Event(events.CANCEL, order.order_id, instrument, order.side, eventPrice(order),
+                                     order.quantity + hidden.get(order.order_id, 0), order.filled_quantity,
+                                     order.timestamp, reason))
+        events.emitMany(self.sink, cancels)
+        return [event.order_id for event in cancels]
+
+    def scheduleExpiry(self, order):
+        if order.expire_at == DAY:
+            self.dayOrders[order.order_id] = order
         else:
-            print("There is no such order")
+            heapq.heappush(self.expiries, (order.expire_at, order.order_id, order))
+
+    def expireOrders(self, now=None):
+        """Cancel the good-till-time orders due at or before `now` (time.time_ns(), by default the current time).
+
+        Only due heap entries are visited, so the cost is the number of
+        orders due, not the number resting. Returns the expired order ids.
+        """
+        if now is None:
+            now = time.time_ns()
+        if self.snapshotLoader is not None:
+            self.snapshotLoader.materializeAll()
+        expiries = self.expiries
+        orders = self.orders
+        expired = []
+        while expiries and expiries[0][0] <= now:
+            order = heapq.heappop(expiries)[2]
+            if order.quantity and orders.get(order.order_id) is order:
+                expired.append(order)
+        if not expired:
+            # nothing live was due, so there is nothing to journal either
+            return []
+        if self.journal is not None:
+            self.journal.logExpire(now)
+        return self.cancelOrders(expired, events.EXPIRED)
+
+    def endOfDay(self):
+        """Cancel every day order still resting or waiting to trigger; returns their ids."""
+        if self.journal is not None:
+            self.journal.logEndOfDay()
+        if self.snapshotLoader is not None:
+            self.snapshotLoader.materializeAll()
+        orders = self.orders
+        expired = [order for order in self.dayOrders.values()
+                   if order.quantity and orders.get(order.order_id) is order]
+        self.dayOrders.clear()
+        return self.cancelOrders(expired, events.EXPIRED)
 
     def match(self, order):
         orderbook = self.orderbooks[order.instrument]
@@ -233,123 +1503,97 @@ class MatchingEngine:
         # else:
         #     # # Order did not cross the spread, place in order book
         #     orderbook.add(order)
+        if self.pendingAcks:
+            self.publishAcks()
 
     def matchBuyOrder(self, order, orderbook):
-
-        # if sell price is less than buy price
-        if (orderbook.bestAsk().price < order.price):
-            new_price = orderbook.bestAsk().price
-
-        while orderbook.asks and order.price >= orderbook.bestAsk().price and order.quantity > 0:
+        ask = orderbook.bestAsk()
+        # trades are stamped when they execute, which for an amended or
+        # triggered order is well after it was received
+        now = time.monotonic_ns()
+
+        self_trade = self.self_trade is not None and order.owner is not None
+        stops = self.stopBooks.get(order.instrument)
+        while ask is not None and order.quantity > 0 and order.price >= ask.price:
+            if self_trade and ask.owner == order.owner:
+                self.preventSelfTrade(order, ask, orderbook)
+                ask = orderbook.bestAsk()
+                continue
+            # fills always execute at the resting (maker) price
+            fill_qty = min(order.quantity, ask.quantity)
+
+            order.quantity -= fill_qty
+            order.filled_quantity += fill_qty
+
+            trade = Trade(order.order_id, order.instrument, ask.price, fill_qty, now)
+            self.trades[order.instrument].append(trade)
+            if stops is not None:
+                stops.release(ask.price, self.triggered)
+
+            # Acknowledgements
+            self.acknowledgeOrder(MatchedOrder(ask.order_id, 'sell', ask.price, fill_qty, ask.instrument, ask.timestamp,
+                                               ask.owner))
+            self.acknowledgeOrder(MatchedOrder(order.order_id, 'buy', ask.price, fill_qty, order.instrument,
+                                               order.timestamp, order.owner))
+
+            orderbook.fill(ask, fill_qty)
+            if ask.quantity == 0:
+                if ask.hidden:
+                    self.replenish(ask, orderbook)
+                elif ask.owner is not None:
+                    self.ownerOrders[ask.owner].pop(ask.order_id, None)
             ask = orderbook.bestAsk()
-            buyMatchedOrder = []
-
-            if ask.quantity <= order.quantity:  # quantity for sale is less than quantity for buy
-
-                order.quantity -= ask.quantity
-                order.filled_quantity += ask.quantity
-                trade = Trade(order.order_id, order.instrument, ask.price, order.filled_quantity)
-                self.trades[order.instrument].append(trade)
-
-                buyMatchedOrder.append(
-                    MatchedOrder(ask.order_id, 'sell', ask.price, ask.quantity, ask.instrument, ask.timestamp))
-
-                if new_price:
-                    buyMatchedOrder.append(
-                        MatchedOrder(order.order_id, 'buy', new_price, order.filled_quantity, order.instrument,
-                                     order.timestamp))
-
-                else:
-                    buyMatchedOrder.append(
-                        MatchedOrder(order.order_id, 'buy', order.price, order.filled_quantity, order.instrument,
-                                     order.timestamp))
-
-                self.acknowledgeOrder(buyMatchedOrder[0])
-                self.acknowledgeOrder(buyMatchedOrder[1])
 
-                orderbook.remove(ask)
-                # Acknowledgements
-
-
-
-            else:  # quantity for sale is more than quantity for buy
-
-                ask.quantity -= order.quantity
-                order.filled_quantity += order.quantity
-                ask.filled_quantity += order.filled_quantity
-
-                trade = Trade(order.order_id, order.instrument, ask.price, order.filled_quantity)
-                self.trades[order.instrument].append(trade)
-                buyMatchedOrder.append(
-                    MatchedOrder(ask.order_id, 'sell', ask.price, ask.filled_quantity, ask.instrument, ask.timestamp))
-
-                if new_price:
-                    buyMatchedOrder.append(
-                        MatchedOrder(order.order_id, 'buy', new_price, order.quantity, order.instrument,
-                                     order.timestamp))
-
-                else:
-                    buyMatchedOrder.append(
-                        MatchedOrder(order.order_id, 'buy', order.price, order.filled_quantity, order.instrument,
-                                     order.timestamp))
-
-                self.acknowledgeOrder(buyMatchedOrder[0])
-                self.acknowledgeOrder(buyMatchedOrder[1])
-
-                order.quantity = 0
-
-            # if buy order not fully filled add remaining back to orderbook
-            if order.quantity > 0:
+        # if buy order not fully filled add remaining back to orderbook
+        if order.quantity > 0:
+            if order.order_type in RESTING_TYPES:
+                if order.display is not None and order.quantity > order.display:
+                    order.hidden += order.quantity - order.display
+                    order.quantity = order.display
                 orderbook.add(order)
+            else:
+                self.cancelRemainder(order)
 
     def matchSellOrder(self, order, orderbook):
-
-        ### check to see if sale price less than buy price. if it is update buy price
-        if (order.price <= orderbook.bestBid().price):
-            new_buy_price = order.price
-
-        while orderbook.bids and order.price >= new_buy_price and order.quantity > 0:
+        bid = orderbook.bestBid()
+        now = time.monotonic_ns()
+
+        self_trade = self.self_trade is not None and order.owner is not None
+        stops = self.stopBooks.get(order.instrument)
+        while bid is not None and order.quantity > 0 and order.price <= bid.price:
+            if self_trade and bid.owner == order.owner:
+                self.preventSelfTrade(order, bid, orderbook)
+                bid = orderbook.bestBid()
+                continue
+            fill_qty = min(order.quantity, bid.quantity)
+
+            order.quantity -= fill_qty
+            order.filled_quantity += fill_qty
+
+            trade = Trade(order.order_id, order.instrument, bid.price, fill_qty, now)
+            self.trades[order.instrument].append(trade)
+            if stops is not None:
+                stops.release(bid.price, self.triggered)
+
+            self.acknowledgeOrder(MatchedOrder(bid.order_id, 'buy', bid.price, fill_qty, bid.instrument, bid.timestamp,
+                                               bid.owner))
+            self.acknowledgeOrder(MatchedOrder(order.order_id, 'sell', bid.price, fill_qty, order.instrument,
+                                               order.timestamp, order.owner))
+
+            orderbook.fill(bid, fill_qty)
+            if bid.quantity == 0:
+                if bid.hidden:
+                    self.replenish(bid, orderbook)
+                elif bid.owner is not None:
+                    self.ownerOrders[bid.owner].pop(bid.order_id, None)
             bid = orderbook.bestBid()
 
-            sellMatchedOrder = []
-
-            if bid.quantity <= order.quantity:  # quantity for buy is less than quantity for sale
-                order.quantity -= bid.quantity
-                order.filled_quantity += bid.quantity
-                bid.quantity = 0
-
-                trade = Trade(order.order_id, order.instrument, new_buy_price, order.filled_quantity)
-                self.trades[order.instrument].append(trade)
-                # self.acknowledgeOrder(MatchedOrder(bid.order_id, 'buy', bid.price, bid.quantity, order.instrument, bid.timestamp))
-                sellMatchedOrder.append(
-                    MatchedOrder(bid.order_id, 'buy', new_buy_price, order.filled_quantity, bid.instrument,
-                                 bid.timestamp))
-                sellMatchedOrder.append(
-                    MatchedOrder(order.order_id, 'sell', order.price, order.filled_quantity, order.instrument,
-                                 order.timestamp))
-
-                self.acknowledgeOrder(sellMatchedOrder[0])
-                self.acknowledgeOrder(sellMatchedOrder[1])
-                orderbook.remove(bid)
-            else:  # quantity for buy is more than quantity for sale
-
-                sellMatchedOrder.append(
-                    MatchedOrder(order.order_id, 'sell', new_buy_price, order.quantity, order.instrument,
-                                 order.timestamp))
-
-                trade = Trade(order.order_id, order.instrument, new_buy_price, order.quantity)
-                self.trades[order.instrument].append(trade)
-                bid.quantity -= order.quantity
-                # self.acknowledgeOrder(MatchedOrder(bid.order_id, 'buy', bid.price, order.quantity, order.instrument, bid.timestamp))
-                order.filled_quantity += order.quantity
-                order.quantity = 0
-                sellMatchedOrder.append(
-                    MatchedOrder(bid.order_id, 'buy', new_buy_price, order.filled_quantity, bid.instrument,
-                                 bid.timestamp))
-
-                self.acknowledgeOrder(sellMatchedOrder[0])
-                self.acknowledgeOrder(sellMatchedOrder[1])
-
         # If the sell order is not fully filled, add the remaining part to the order book
         if order.quantity > 0:
-            orderbook.add(order)
\ No newline at end of file
+            if order.order_type in RESTING_TYPES:
+                if order.display is not None and order.quantity > order.display:
+                    order.hidden += order.quantity - order.display
+                    order.quantity = order.display
+                orderbook.add(order)
+            else:
+                self.cancelRemainder(order)
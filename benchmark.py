@@ -0,0 +1,450 @@
+import argparse
+import contextlib
+import functools
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+import MatchingEngine as engine
+import events
+import journal
+import sharding
+
+
+def order_flow(n, seed=42, instrument='BTC', mid=100, spread=5):
+    rng = random.Random(seed)
+    for _ in range(n):
+        side = rng.choice(('buy', 'sell'))
+        price = mid + rng.randint(-spread, spread)
+        yield instrument, side, price, rng.randint(1, 10)
+
+
+def orders_per_second(eng, flow):
+    flow = list(flow)
+    start = time.perf_counter()
+    for instrument, side, price, quantity in flow:
+        eng.placeOrder(instrument, side, price, quantity)
+    return len(flow) / (time.perf_counter() - start)
+
+
+def bench_console_output(n=20000, book_factory=engine.PriceLevelBook):
+    """orders/sec with the ring-buffer sink versus printing every event.
+
+    Console output goes to os.devnull so the number is formatting and write
+    cost, not how fast the terminal scrolls.
+    """
+    quiet_engine = engine.MatchingEngine(book_factory, sink=events.RingBufferSink())
+    quiet = orders_per_second(quiet_engine, order_flow(n))
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        console_engine = engine.MatchingEngine(book_factory, sink=events.ConsoleSink())
+        console = orders_per_second(console_engine, order_flow(n))
+
+    return {"quiet_orders_per_sec": quiet, "console_orders_per_sec": console}
+
+
+def bench_batch(n=20000, book_factory=engine.PriceLevelBook):
+    """orders/sec placing orders one at a time versus through placeOrders."""
+    flow = list(order_flow(n))
+    single = orders_per_second(engine.MatchingEngine(book_factory, sink=events.NullSink()), flow)
+
+    batch = {"instrument": [row[0] for row in flow], "side": [row[1] for row in flow],
+             "price": [row[2] for row in flow], "quantity": [row[3] for row in flow]}
+    eng = engine.MatchingEngine(book_factory, sink=events.NullSink())
+    start = time.perf_counter()
+    eng.placeOrders(batch)
+    batched = n / (time.perf_counter() - start)
+
+    return {"single_orders_per_sec": single, "batch_orders_per_sec": batched}
+
+
+def allocated_bytes(build):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def resting_order_bytes(n, book_factory):
+    def build():
+        eng = engine.MatchingEngine(book_factory, sink=events.NullSink())
+        # bids spread over 100 levels, so nothing trades
+        for i in range(n):
+            eng.placeOrder('BTC', 'buy', 1 + i % 100, 1)
+        return eng
+    return allocated_bytes(build) / n
+
+
+def trade_bytes(n):
+    def build():
+        trades = []
+        for i in range(n):
+            trades.append(engine.Trade(i, 'BTC', 100, 1))
+        return trades
+    return allocated_bytes(build) / n
+
+
+def dict_backed(cls):
+    """A plain class with the methods of slotted `cls`, whose instances keep their attributes in a __dict__.
+
+    A subclass without __slots__ would not do: its instances still store
+    every slotted attribute in the slots and leave the __dict__ empty.
+    """
+    namespace = {name: value for name, value in vars(cls).items()
+                 if name not in cls.__slots__ and name not in ('__slots__', '__dict__', '__weakref__')}
+    return type(cls.__name__, (), namespace)
+
+
+def bench_memory(n=100000, book_factory=engine.PriceLevelBook):
+    """Bytes per resting order and per trade, dict-backed versus slotted records.
+
+    The dict-backed numbers come from swapping in dict_backed() copies of
+    Order and Trade, laid out as they were before __slots__.
+    """
+    slotted = {"order_bytes": resting_order_bytes(n, book_factory), "trade_bytes": trade_bytes(n)}
+
+    order_cls, trade_cls = engine.Order, engine.Trade
+    engine.Order = dict_backed(order_cls)
+    engine.Trade = dict_backed(trade_cls)
+    try:
+        unslotted = {"order_bytes": resting_order_bytes(n, book_factory), "trade_bytes": trade_bytes(n)}
+    finally:
+        engine.Order, engine.Trade = order_cls, trade_cls
+
+    return {"dict": unslotted, "slots": slotted}
+
+
+def bench_recovery(n=200000, book_factory=engine.PriceLevelBook):
+    """Seconds to recover an engine by full journal replay versus from a snapshot.
+
+    The snapshot restore is timed twice: lazily (books rebuilt on first use)
+    and with every book rebuilt up front.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        journal_path = os.path.join(tmp, 'journal.bin')
+        snapshot_path = os.path.join(tmp, 'snapshot.bin')
+
+        eng = engine.MatchingEngine(book_factory, sink=events.NullSink(), journal_path=journal_path)
+        for instrument, side, price, quantity in order_flow(n, spread=50):
+            eng.placeOrder(instrument, side, price, quantity)
+        eng.snapshot(snapshot_path)
+        eng.journal.close()
+
+        start = time.perf_counter()
+        journal.replay(journal_path, book_factory=book_factory)
+        replay = time.perf_counter() - start
+
+        start = time.perf_counter()
+        restored = engine.MatchingEngine.from_snapshot(snapshot_path, book_factory=book_factory)
+        lazy = time.perf_counter() - start
+        restored.snapshotLoader.materializeAll()
+        full = time.perf_counter() - start
+
+    return {"resting_orders": len(restored.orders), "replay_seconds": replay,
+            "snapshot_lazy_seconds": lazy, "snapshot_full_seconds": full}
+
+
+def bench_sharding(n=100000, max_workers=None, instruments=64, book_factory=engine.PriceLevelBook):
+    """orders/sec through a ShardRouter with 1..max_workers worker processes.
+
+    Instruments are assigned round-robin so every shard gets the same load.
+    """
+    max_workers = max_workers or os.cpu_count()
+    names = [f"INST{i}" for i in range(instruments)]
+    rng = random.Random(42)
+    flow = [(rng.choice(names), side, price, quantity)
+            for _, side, price, quantity in order_flow(n)]
+
+    results = {}
+    for workers in range(1, max_workers + 1):
+        partition = {name: i % workers for i, name in enumerate(names)}
+        router = sharding.ShardRouter(workers, partition, book_factory=book_factory)
+        start = time.perf_counter()
+        for instrument, side, price, quantity in flow:
+            router.placeOrder(instrument, side, price, quantity)
+        router.flush()
+        results[workers] = n / (time.perf_counter() - start)
+        router.close()
+    return results
+
+
+PLACE = 'place'
+CANCEL = 'cancel'
+
+BOOKS = {
+    'price_level': engine.PriceLevelBook,
+    'heap': engine.OrderBook,
+    'heap_lazy': functools.partial(engine.OrderBook, lazy=True),
+}
+
+# Seeded order-flow generators for the suite. Each yields commands
+# (PLACE, instrument, side, price, quantity) and (CANCEL, i), where i is
+# the index of an earlier PLACE in the same flow.
+
+
+def passive_flow(n, seed=1, levels=50, mid=1000):
+    """Book build-up: orders on both sides that never cross."""
+    rng = random.Random(seed)
+    for _ in range(n):
+        if rng.random() < 0.5:
+            yield PLACE, 'BTC', 'buy', mid - rng.randint(1, levels), rng.randint(1, 10)
+        else:
+            yield PLACE, 'BTC', 'sell', mid + rng.randint(1, levels), rng.randint(1, 10)
+
+
+def sweep_flow(n, seed=2, levels=20, orders_per_level=3, mid=1000):
+    """Rest `levels` levels on one side, then one order that sweeps all of them; sides alternate."""
+    rng = random.Random(seed)
+    emitted = 0
+    side = 'sell'
+    while emitted < n:
+        total = 0
+        for level in range(1, levels + 1):
+            price = mid + level if side == 'sell' else mid - level
+            for _ in range(orders_per_level):
+                quantity = rng.randint(1, 10)
+                total += quantity
+                yield PLACE, 'BTC', side, price, quantity
+        aggressor = 'buy' if side == 'sell' else 'sell'
+        yield PLACE, 'BTC', aggressor, mid + levels if aggressor == 'buy' else mid - levels, total
+        emitted += levels * orders_per_level + 1
+        side = aggressor
+
+
+def cancel_storm_flow(n, seed=3, burst=1000, cancel_ratio=0.9, levels=50, mid=1000):
+    """Bursts of passive orders, each followed by cancels of most of the live orders in random order."""
+    rng = random.Random(seed)
+    live = []
+    index = 0
+    emitted = 0
+    while emitted < n:
+        for order in passive_flow(burst, rng.random(), levels, mid):
+            yield order
+            live.append(index)
+            index += 1
+        rng.shuffle(live)
+        cancels = int(len(live) * cancel_ratio)
+        for i in live[:cancels]:
+            yield CANCEL, i
+        live = live[cancels:]
+        emitted += burst + cancels
+
+
+def fanout_flow(n, seed=4, instruments=1000, mid=100, spread=5):
+    """Crossing flow spread uniformly over many instruments."""
+    rng = random.Random(seed)
+    names = [f"INST{i}" for i in range(instruments)]
+    for _ in range(n):
+        yield (PLACE, rng.choice(names), rng.choice(('buy', 'sell')), mid + rng.randint(-spread, spread),
+               rng.randint(1, 10))
+
+
+def deep_book_flow(n, seed=5, levels=5000, mid=100000):
+    """A book `levels` deep per side, then small aggressive orders and cancels deep in the book."""
+    rng = random.Random(seed)
+    build = n * 4 // 5
+    for i in range(build):
+        if i % 2:
+            yield PLACE, 'BTC', 'buy', mid - rng.randint(1, levels), rng.randint(1, 10)
+        else:
+            yield PLACE, 'BTC', 'sell', mid + rng.randint(1, levels), rng.randint(1, 10)
+    for _ in range(n - build):
+        if rng.random() < 0.5:
+            yield CANCEL, rng.randrange(build)
+        else:
+            side = rng.choice(('buy', 'sell'))
+            yield PLACE, 'BTC', side, mid + levels if side == 'buy' else mid - levels, rng.randint(1, 5)
+
+
+SCENARIOS = {
+    'passive': passive_flow,
+    'sweep': sweep_flow,
+    'cancel_storm': cancel_storm_flow,
+    'fanout': fanout_flow,
+    'deep_book': deep_book_flow,
+}
+
+
+def percentiles(samples_ns):
+    """p50/p90/p99/p99.9/max of latency samples in ns, reported in microseconds."""
+    if not samples_ns:
+        return {}
+    ordered = sorted(samples_ns)
+    last = len(ordered) - 1
+    summary = {f"p{q:g}_us": ordered[min(last, int(q / 100 * len(ordered)))] / 1000
+               for q in (50, 90, 99, 99.9)}
+    summary["max_us"] = ordered[last] / 1000
+    return summary
+
+
+def apply_flow(eng, flow, latencies=None):
+    """Send a flow to `eng`; with `latencies`, record each command's ns under its kind."""
+    ids = []
+    clock = time.perf_counter_ns
+    for command in flow:
+        if command[0] == PLACE:
+            start = clock()
+            ids.append(eng.placeOrder(*command[1:]))
+            if latencies is not None:
+                latencies[PLACE].append(clock() - start)
+        else:
+            start = clock()
+            eng.cancelOrder(ids[command[1]])
+            if latencies is not None:
+                latencies[CANCEL].append(clock() - start)
+
+
+def peak_bytes(run):
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_scenario(flow, book_factory):
+    """Throughput, latency percentiles per command kind and peak traced memory of one flow.
+
+    Timing and memory come from separate runs, since tracemalloc slows
+    every allocation down.
+    """
+    def new_engine():
+        return engine.MatchingEngine(book_factory, sink=events.NullSink())
+
+    latencies = {PLACE: [], CANCEL: []}
+    eng = new_engine()
+    start = time.perf_counter()
+    apply_flow(eng, flow, latencies)
+    elapsed = time.perf_counter() - start
+    count = len(flow)
+
+    return {"commands": count, "orders_per_sec": count / elapsed,
+            "place_latency": percentiles(latencies[PLACE]),
+            "cancel_latency": percentiles(latencies[CANCEL]),
+            "resting_orders": sum(len(book.restingOrders()) for book in eng.orderbooks.values()),
+            "peak_bytes": peak_bytes(lambda: apply_flow(new_engine(), flow))}
+
+
+def bench_book_ops(n, book_factory, seed=6, levels=1000):
+    """Latency of OrderBook.add and OrderBook.remove on their own, without matching."""
+    rng = random.Random(seed)
+    orders = [engine.Order('BTC', i, 'buy' if i % 2 else 'sell',
+                           1000 - rng.randint(1, levels) if i % 2 else 1000 + rng.randint(1, levels),
+                           rng.randint(1, 10), i)
+              for i in range(1, n + 1)]
+    book = book_factory()
+    clock = time.perf_counter_ns
+    adds = []
+    for order in orders:
+        start = clock()
+        book.add(order)
+        adds.append(clock() - start)
+
+    rng.shuffle(orders)
+    removes = []
+    for order in orders:
+        start = clock()
+        book.remove(order)
+        removes.append(clock() - start)
+    return {"add_latency": percentiles(adds), "remove_latency": percentiles(removes)}
+
+
+def run_suite(n=50000, scenarios=None, books=None):
+    """Every scenario against every book type; the result is JSON-serialisable."""
+    results = {"meta": {"python": platform.python_version(), "machine": platform.machine(),
+                        "n": n, "started": time.strftime('%Y-%m-%dT%H:%M:%S')},
+               "scenarios": {}, "book_ops": {}}
+    for name in scenarios or SCENARIOS:
+        flow = list(SCENARIOS[name](n))
+        results["scenarios"][name] = {book: run_scenario(flow, BOOKS[book]) for book in books or BOOKS}
+    for book in books or BOOKS:
+        results["book_ops"][book] = bench_book_ops(n, BOOKS[book])
+    return results
+
+
+def compare(old, new):
+    """Lines of new/old orders_per_sec and p99 place latency per scenario and book."""
+    lines = []
+    for name, by_book in new["scenarios"].items():
+        for book, result in by_book.items():
+            before = old.get("scenarios", {}).get(name, {}).get(book)
+            if before is None:
+                continue
+            rate = result["orders_per_sec"] / before["orders_per_sec"]
+            p99 = result["place_latency"].get("p99_us", 0) / (before["place_latency"].get("p99_us") or 1)
+            lines.append(f"{name:<13} {book:<12} orders/sec x{rate:5.2f}   p99 place x{p99:5.2f}")
+    return lines
+
+
+def print_suite(results):
+    for name, by_book in results["scenarios"].items():
+        for book, result in by_book.items():
+            place = result["place_latency"]
+            cancel = result["cancel_latency"]
+            line = (f"{name:<13} {book:<12} {result['orders_per_sec']:>10,.0f} orders/sec"
+                    f"  place p50 {place['p50_us']:6.1f} p99 {place['p99_us']:7.1f} us")
+            if cancel:
+                line += f"  cancel p50 {cancel['p50_us']:6.1f} p99 {cancel['p99_us']:7.1f} us"
+            print(line + f"  peak {result['peak_bytes'] / 2 ** 20:6.1f} MiB")
+    for book, result in results["book_ops"].items():
+        print(f"book ops      {book:<12} add p50 {result['add_latency']['p50_us']:6.2f} us"
+              f"  remove p50 {result['remove_latency']['p50_us']:6.2f} us"
+              f"  p99 {result['remove_latency']['p99_us']:7.2f} us")
+
+
+def main_report():
+    result = bench_console_output()
+    print(f"ring buffer sink : {result['quiet_orders_per_sec']:>12,.0f} orders/sec")
+    print(f"console sink     : {result['console_orders_per_sec']:>12,.0f} orders/sec")
+
+    result = bench_batch()
+    print(f"placeOrder       : {result['single_orders_per_sec']:>12,.0f} orders/sec")
+    print(f"placeOrders      : {result['batch_orders_per_sec']:>12,.0f} orders/sec")
+
+    result = bench_memory()
+    for layout in ("dict", "slots"):
+        print(f"{layout:<5} records    : {result[layout]['order_bytes']:>8,.0f} bytes/resting order"
+              f"  {result[layout]['trade_bytes']:>6,.0f} bytes/trade")
+
+    result = bench_recovery()
+    print(f"journal replay   : {result['replay_seconds']:>12.3f} s")
+    print(f"snapshot (lazy)  : {result['snapshot_lazy_seconds']:>12.3f} s")
+    print(f"snapshot (full)  : {result['snapshot_full_seconds']:>12.3f} s"
+          f"  ({result['resting_orders']:,} resting orders)")
+
+    for workers, rate in bench_sharding().items():
+        print(f"{workers:>2} shard worker(s): {rate:>10,.0f} orders/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Matching engine benchmarks")
+    parser.add_argument("mode", choices=["report", "suite"], nargs="?", default="report")
+    parser.add_argument("-n", type=int, default=50000, help="commands per suite scenario")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--book", action="append", choices=sorted(BOOKS))
+    parser.add_argument("--out", help="write suite results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier suite run to compare against")
+    args = parser.parse_args()
+
+    if args.mode == "report":
+        main_report()
+    else:
+        results = run_suite(args.n, args.scenario, args.book)
+        print_suite(results)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                for line in compare(json.load(f), results):
+                    print(line)
@@ -0,0 +1,157 @@
+from collections import deque, namedtuple
+import datetime
+import json
+import time
+
+# Event kinds emitted by MatchingEngine
+ACCEPTED = 'accepted'
+FILL = 'fill'
+CANCEL = 'cancel'
+REJECT = 'reject'
+AMENDED = 'amended'
+TRIGGERED = 'triggered'
+
+# Reject reasons
+NO_SUCH_ORDER = 'no such order'
+ALREADY_FILLED = 'already fully filled'
+FOK_UNFILLED = 'fill or kill order cannot be filled'
+POST_ONLY_CROSSED = 'post-only order would trade'
+ORDER_TOO_LARGE = 'order size above limit'
+OUTSIDE_PRICE_BAND = 'price outside band'
+NOTIONAL_LIMIT = 'open notional limit'
+POSITION_LIMIT = 'position limit'
+# Reasons on cancels made by the engine itself
+SELF_TRADE = 'self-trade prevented'
+EXPIRED = 'expired'
+
+# One compact record per engine event. For fills `quantity` is the quantity
+# traded, for cancels it is the quantity taken off the book, for amends the
+# order's new price and remaining quantity; triggered stops carry their stop
+# price. `reason` is set on rejects and on cancels made by self-trade
+# prevention or expiry.
+Event = namedtuple('Event', 'kind order_id instrument side price quantity filled_quantity timestamp reason')
+
+
+class ConsoleSink:
+    """Human-readable printing of every event, as the engine used to do inline.
+
+    Events carry integer ticks and lots; `spec` maps an instrument to its
+    InstrumentSpec so they print as decimals (MatchingEngine.spec does this).
+    """
+
+    def __init__(self, spec=None):
+        self.spec = spec
+        # event timestamps are time.monotonic_ns(); shift them onto the wall clock
+        self.wall_offset = time.time_ns() - time.monotonic_ns()
+
+    def wallTime(self, timestamp):
+        return datetime.datetime.fromtimestamp((timestamp + self.wall_offset) / 1e9)
+
+    def emit(self, event):
+        price, quantity, filled_quantity = event.price, event.quantity, event.filled_quantity
+        if self.spec is not None and event.instrument is not None:
+            spec = self.spec(event.instrument)
+            price = 'market' if price is None else spec.fromTicks(price)
+            quantity = spec.fromLots(quantity)
+            filled_quantity = spec.fromLots(filled_quantity)
+
+        if event.kind == ACCEPTED:
+            timestamp = self.wallTime(event.timestamp)
+            kind = "Buy" if event.side == 'buy' else "Sale"
+            print(f"{timestamp} : {kind} order {event.order_id, event.instrument, price, quantity} is added to orderbook")
+
+        elif event.kind == FILL:
+            timeACk = self.wallTime(event.timestamp)
+
+            # Store the order details in a dictionary with the "message" key first
+            order_details = {
+                "message": f"Order acknowledgement for {'buy' if event.side == 'buy' else 'sell'} order {event.order_id, event.instrument}",
+                "order_id": event.order_id,
+                "instrument": event.instrument,
+                "price": price,
+                "filled_quantity": quantity,
+                "timestamp": timeACk.isoformat(),
+                "action": "Bought" if event.side == "buy" else "Sold",
+            }
+            print(json.dumps(order_details, indent=2, default=str))
+            print("----------------------------------------------------------------------------------------------------")
+
+        elif event.kind == CANCEL:
+            if event.filled_quantity:
+                print(f"Order ID: {event.order_id} is cancelled. Filled quantity: {filled_quantity}, Remaining quantity: {quantity}")
+            else:
+                print(f"Order ID: {event.order_id} is cancelled")
+
+        elif event.kind == AMENDED:
+            print(f"Order ID: {event.order_id} amended. Price: {price}, Remaining quantity: {quantity}")
+
+        elif event.kind == TRIGGERED:
+            print(f"Stop order {event.order_id} triggered at stop price {price}")
+
+        elif event.kind == REJECT:
+            if event.reason == NO_SUCH_ORDER:
+                print("There is no such order")
+            elif event.reason == ALREADY_FILLED:
+                print(f"Cannot cancel order {event.order_id}, already fully filled")
+            else:
+                print(f"Order {event.order_id} rejected: {event.reason}")
+
+
+def emitMany(sink, batch):
+    """Hand a batch of events to `sink`, in one call if it has emitMany."""
+    emit_many = getattr(sink, 'emitMany', None)
+    if emit_many is not None:
+        emit_many(batch)
+    else:
+        for event in batch:
+            sink.emit(event)
+
+
+class RingBufferSink:
+    """Keeps the most recent `capacity` events in memory; nothing is formatted."""
+
+    def __init__(self, capacity=65536):
+        self.events = deque(maxlen=capacity)
+        self.emit = self.events.append
+        self.emitMany = self.events.extend
+
+    def drain(self):
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+
+class CallbackSink:
+    """Hands every event to `callback(event)`."""
+
+    def __init__(self, callback):
+        self.emit = callback
+
+
+class FileSink:
+    """Appends one tab-separated line per event to `path`."""
+
+    def __init__(self, path, buffering=1 << 16):
+        self.file = open(path, 'a', buffering=buffering)
+
+    def emit(self, event):
+        self.file.write('\t'.join(map(str, event)) + '\n')
+
+    def emitMany(self, batch):
+        self.file.write(''.join('\t'.join(map(str, event)) + '\n' for event in batch))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NullSink:
+    """Discards every event."""
+
+    def emit(self, event):
+        pass
+
+    def emitMany(self, batch):
+        pass
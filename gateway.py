@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import time
+
+import MatchingEngine as engine
+import events
+from ringBuffer import RingFullError
+
+
+class Session:
+    """One client connection: buffered outgoing messages with write backpressure.
+
+    Outgoing messages collect in `buffer` and are written once per engine
+    batch. When the socket's write buffer passes `high_water` the session
+    stops reading new commands until the client has drained it.
+    """
+
+    def __init__(self, reader, writer, high_water, name):
+        self.name = name  # owner of the orders placed through this session
+        self.reader = reader
+        self.writer = writer
+        self.high_water = high_water
+        self.buffer = bytearray()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = False
+
+    def send(self, message):
+        self.buffer += json.dumps(message, separators=(',', ':')).encode()
+        self.buffer += b'\n'
+
+    def flush(self):
+        if not self.buffer or self.closed:
+            return
+        self.writer.write(self.buffer)
+        self.buffer = bytearray()
+        if self.writer.transport.get_write_buffer_size() > self.high_water and self.writable.is_set():
+            self.writable.clear()
+            asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.closed = True
+        self.writable.set()
+
+
+class Gateway:
+    """asyncio TCP front-end for a MatchingEngine speaking line-delimited JSON.
+
+    Requests, one JSON object per line:
+        {"op": "place", "instrument": "BTC", "side": "buy", "price": "100.5", "quantity": "2", "ref": 1}
+        {"op": "place", "order_type": "ioc", ...} (any of MatchingEngine.ORDER_TYPES; market needs no price)
+        {"op": "place", "order_type": "stop_limit", "stop_price": "101", ...} (stop needs no price)
+        {"op": "place", "display_quantity": "1", ...} (limit or post-only iceberg showing 1 at a time)
+        {"op": "place", "expire_in": "30", ...} or {"op": "place", "day": true, ...} (good for 30 seconds or the day)
+        {"op": "cancel", "order_id": 7, "ref": 2}
+        {"op": "amend", "order_id": 7, "price": "100.4", "quantity": "1", "ref": 3}
+        {"op": "cancel_all", "ref": 4}
+    Replies carry a "type" of accepted, triggered, fill, amended, cancel or reject, the order_id
+    and, for replies to a request, its "ref". Fills reach the session that
+    placed the order whichever session's order triggered them. cancel_all
+    cancels every resting order placed through the session.
+
+    Commands from all sessions are coalesced into micro-batches: whatever
+    arrived within `batch_interval` seconds goes to the engine in one
+    placeOrders call.
+    """
+
+    def __init__(self, eng=None, batch_interval=0.0002, high_water=1 << 20):
+        self.collected = []
+        self.engine = eng or engine.MatchingEngine(engine.PriceLevelBook)
+        self.engine.sink = events.CallbackSink(self.collected.append)
+        self.batch_interval = batch_interval
+        self.high_water = high_water
+        self.inbound = []
+        self.work = asyncio.Event()
+        self.owner = {}  # resting order_id -> Session
+        self.dirty = set()  # sessions with buffered replies
+        self.batches = 0
+        self.sessions = 0
+
+    async def serve(self, host='127.0.0.1', port=9000):
+        batcher = asyncio.ensure_future(self.runBatches())
+        server = await asyncio.start_server(self.handleClient, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    async def handleClient(self, reader, writer):
+        self.sessions += 1
+        session = Session(reader, writer, self.high_water, f"session-{self.sessions}")
+        try:
+            while True:
+                await session.writable.wait()
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    message = None
+                if not isinstance(message, dict):
+                    session.send({"type": "reject", "reason": "malformed request"})
+                    session.flush()
+                    continue
+                self.inbound.append((session, message))
+                self.work.set()
+        except ConnectionError:
+            pass
+        finally:
+            session.closed = True
+            writer.close()
+
+    async def runBatches(self):
+        while True:
+            await self.work.wait()
+            if self.batch_interval:
+                await asyncio.sleep(self.batch_interval)
+            self.work.clear()
+            inbound, self.inbound = self.inbound, []
+            self.process(inbound)
+
+    def process(self, inbound):
+        batch = None
+        rows = []
+
+        for session, message in inbound:
+            self.dirty.add(session)
+            op = message.get('op')
+            ref = message.get('ref')
+            if batch is not None and op in ('cancel', 'amend', 'cancel_all'):
+                self.placeBatch(batch, rows)
+                batch, rows = None, []
+            # whatever one request does wrong is rejected back to its session, it never
+            # stops the batcher that every session depends on
+            try:
+                if op == 'place':
+                    row = self.newOrder(session, message)
+                    if batch is None:
+                        batch = engine.newBatch(engine.NEW_ORDER_COLUMNS)
+                    for name, value in zip(engine.NEW_ORDER_COLUMNS, row):
+                        batch[name].append(value)
+                    rows.append((session, ref))
+                elif op == 'cancel_all':
+                    self.route(dict.fromkeys(self.engine.cancelAll(session.name), ref))
+                elif op in ('cancel', 'amend'):
+                    order_id = message.get('order_id')
+                    if not isinstance(order_id, int) or self.owner.get(order_id) is not session:
+                        session.send({"type": "reject", "ref": ref, "order_id": order_id,
+                                      "reason": events.NO_SUCH_ORDER})
+                        continue
+                    if op == 'cancel':
+                        self.engine.cancelOrder(order_id)
+                    else:
+                        self.engine.amendOrder(order_id, message.get('price'), message.get('quantity'))
+                    self.route({order_id: ref})
+                else:
+                    session.send({"type": "reject", "ref": ref, "reason": f"unknown op {op!r}"})
+            except Exception as e:
+                reply = {"type": "reject", "ref": ref, "reason": str(e)}
+                if op in ('cancel', 'amend'):
+                    reply["order_id"] = message.get('order_id')
+                session.send(reply)
+
+        if batch is not None:
+            self.placeBatch(batch, rows)
+        # expiry is checked once per batch, so it is only as prompt as the traffic
+        expired = self.engine.expireOrders()
+        if expired:
+            self.route(dict.fromkeys(expired))
+        if self.engine.journal is not None:
+            # nothing is acknowledged to a client before its command is on disk
+            self.engine.journal.flush()
+        self.batches += 1
+        for session in self.dirty:
+            session.flush()
+        self.dirty.clear()
+
+    def newOrder(self, session, message):
+        """A place request checked and scaled into a row of engine.NEW_ORDER_COLUMNS."""
+        instrument = message['instrument']
+        if not isinstance(instrument, str):
+            raise ValueError(f"instrument must be a string, not {instrument!r}")
+        spec = self.engine.spec(instrument)
+        order_type = message.get('order_type', engine.LIMIT)
+        if order_type not in engine.ORDER_TYPES:
+            raise ValueError(f"unknown order type {order_type!r}")
+        price = None if order_type in (engine.MARKET, engine.STOP) else spec.toTicks(message['price'])
+        stop_price = None
+        if order_type in engine.TRIGGERED_TYPES:
+            stop_price = spec.toTicks(message['stop_price'])
+        quantity = spec.toLots(message['quantity'])
+        display = message.get('display_quantity')
+        if display is not None:
+            display = engine.icebergDisplay(order_type, quantity, spec.toLots(display))
+        expire_at = None
+        if message.get('day'):
+            expire_at = engine.DAY
+        elif message.get('expire_in') is not None:
+            expire_at = time.time_ns() + int(float(message['expire_in']) * 1e9)
+        engine.orderExpiry(order_type, expire_at)
+        side = message['side']
+        if side not in ('buy', 'sell'):
+            raise ValueError(f"unknown side {side!r}")
+        return instrument, side, price, quantity, session.name, order_type, stop_price, display, expire_at
+
+    def placeBatch(self, batch, rows):
+        try:
+            order_ids, _ = self.engine.placeOrders(batch, scaled=True)
+        except (ValueError, ArithmeticError, RingFullError) as e:
+            # placeOrders refuses a batch before placing any of it
+            for session, ref in rows:
+                session.send({"type": "reject", "ref": ref, "reason": str(e)})
+            return
+        refs = {}
+        for order_id, (session, ref) in zip(order_ids, rows):
+            self.owner[order_id] = session
+            refs[order_id] = ref
+        self.route(refs)
+
+    def route(self, refs):
+        """Send the events collected from the engine to the sessions owning their orders."""
+        orders = self.engine.orders
+        done = []
+        for event in self.collected:
+            session = self.owner.get(event.order_id)
+            if session is None:
+                continue
+            spec = self.engine.spec(event.instrument)
+            message = {"type": event.kind, "order_id": event.order_id, "instrument": event.instrument,
+                       "side": event.side,
+                       "price": None if event.price is None else str(spec.fromTicks(event.price)),
+                       "quantity": str(spec.fromLots(event.quantity))}
+            ref = refs.get(event.order_id)
+            if ref is not None and event.kind != events.FILL:
+                message["ref"] = ref
+            session.send(message)
+            self.dirty.add(session)
+            done.append(event.order_id)
+        self.collected.clear()
+
+        # forget orders that are no longer resting once all their events are out
+        for order_id in done:
+            order = orders.get(order_id)
+            if order is None or order.quantity == 0:
+                self.owner.pop(order_id, None)
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def loadClient(host, port, orders, seed, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    for i in range(orders):
+        side = 'buy' if (seed + i) % 2 else 'sell'
+        price = 100 + (seed * 7 + i) % 11 - 5
+        request = {"op": "place", "instrument": "BTC", "side": side, "price": str(price), "quantity": "1", "ref": i}
+        start = time.perf_counter()
+        writer.write(json.dumps(request).encode() + b'\n')
+        while True:
+            reply = json.loads(await reader.readline())
+            if reply.get("ref") == i:
+                break
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def loadGenerate(host='127.0.0.1', port=9000, clients=50, orders=200):
+    """Closed-loop load: each client sends an order and waits for its reply.
+
+    Returns end-to-end latency percentiles in microseconds.
+    """
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(loadClient(host, port, orders, seed, latencies) for seed in range(clients)))
+    elapsed = time.perf_counter() - start
+    return {"orders": len(latencies), "orders_per_sec": len(latencies) / elapsed,
+            "p50_us": percentile(latencies, 0.50) * 1e6, "p99_us": percentile(latencies, 0.99) * 1e6}
+
+
+async def selfTest(port, clients, orders):
+    gateway = Gateway()
+    server = asyncio.ensure_future(gateway.serve(port=port))
+    await asyncio.sleep(0.1)
+    try:
+        return await loadGenerate(port=port, clients=clients, orders=orders)
+    finally:
+        server.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Matching engine TCP gateway")
+    parser.add_argument("mode", choices=["serve", "loadgen", "selftest"], nargs="?", default="selftest")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--orders", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        asyncio.run(Gateway().serve(args.host, args.port))
+    else:
+        if args.mode == "loadgen":
+            result = asyncio.run(loadGenerate(args.host, args.port, args.clients, args.orders))
+        else:
+            result = asyncio.run(selfTest(args.port, args.clients, args.orders))
+        print(f"{result['orders']:,} orders, {result['orders_per_sec']:,.0f} orders/sec, "
+              f"p50 {result['p50_us']:,.0f} us, p99 {result['p99_us']:,.0f} us")
@@ -0,0 +1,156 @@
+import json
+import sys
+import time
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS  # buckets per power of two, so values are kept to within 1/16
+BUCKETS = (64 - SUB_BITS + 1) * SUB_BUCKETS
+
+# Engine methods timed while instrumentation is enabled, with how each one
+# finds the instrument it is working on from its first argument.
+TIMED = {
+    'processOrder': lambda eng, order: order.instrument,
+    'matchBuyOrder': lambda eng, order: order.instrument,
+    'matchSellOrder': lambda eng, order: order.instrument,
+    'acknowledgeOrder': lambda eng, matched: matched.instrument,
+    'cancelOrder': lambda eng, order_id: getattr(eng.orders.get(order_id), 'instrument', None),
+}
+
+
+def bucketIndex(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucketValue(index):
+    """Highest value that falls into bucket `index`."""
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram:
+    """HDR-style log-linear histogram of non-negative integers (ns latencies).
+
+    record() is one bucket increment; percentiles are accurate to 1/16 of
+    the value, whatever its magnitude.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        self.counts[bucketIndex(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = max(1, round(q / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucketValue(index), self.max)
+        return self.max
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    def summary(self):
+        """count, mean, min, p50, p90, p99, p99.9 and max, in ns."""
+        if not self.count:
+            return {"count": 0}
+        summary = {"count": self.count, "mean": self.total / self.count, "min": self.min}
+        for q in (50, 90, 99, 99.9):
+            summary[f"p{q:g}"] = self.percentile(q)
+        summary["max"] = self.max
+        return summary
+
+
+class Instrumentation:
+    """Latency histograms per engine operation and instrument, plus counters.
+
+    With `dump_interval` (seconds) set, `dump` is called with the engine's
+    stats() at most that often, checked whenever an operation is timed.
+    """
+
+    def __init__(self, dump_interval=None, dump=None):
+        self.histograms = {}  # (operation, instrument) -> Histogram
+        self.counters = {"fills": 0, "levels_swept": 0}
+        self.dump_interval = dump_interval
+        self.dump = dump or dumpJson
+        self.nextDump = None
+
+    def record(self, operation, instrument, elapsed):
+        key = (operation, instrument)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.record(elapsed)
+
+    def latency(self):
+        """{operation: {"all": summary, "instruments": {instrument: summary}}}"""
+        result = {}
+        for (operation, instrument), histogram in self.histograms.items():
+            entry = result.get(operation)
+            if entry is None:
+                entry = result[operation] = {"all": Histogram(), "instruments": {}}
+            entry["all"].merge(histogram)
+            if instrument is not None:
+                entry["instruments"][instrument] = histogram.summary()
+        for entry in result.values():
+            entry["all"] = entry["all"].summary()
+        return result
+
+    def timed(self, eng, operation, method, instrument_of):
+        """`method` wrapped to record its latency and, for the match loops, fills and levels swept."""
+        clock = time.perf_counter_ns
+        record = self.record
+        sweeps = operation in ('matchBuyOrder', 'matchSellOrder')
+
+        def wrapper(*args, **kwargs):
+            instrument = instrument_of(eng, args[0])
+            if sweeps:
+                tape = eng.trades[instrument]
+                last_trade = tape.seq
+            start = clock()
+            result = method(*args, **kwargs)
+            end = clock()
+            record(operation, instrument, end - start)
+            if sweeps and tape.seq != last_trade:
+                self.counters["fills"] += tape.seq - last_trade
+                self.counters["levels_swept"] += len({trade.price for trade in tape.trades(last_trade + 1)})
+            if self.dump_interval is not None:
+                if self.nextDump is None:
+                    self.nextDump = end + int(self.dump_interval * 1e9)
+                elif end >= self.nextDump:
+                    self.nextDump = end + int(self.dump_interval * 1e9)
+                    self.dump(eng.stats())
+            return result
+
+        wrapper.__wrapped__ = method
+        return wrapper
+
+
+def dumpJson(stats, file=None):
+    print(json.dumps(stats, default=str), file=file or sys.stderr)
@@ -0,0 +1,380 @@
+import mmap
+import os
+import struct
+import time
+
+import MatchingEngine as engine
+import events
+
+MAGIC = b'MEJ1'
+HEADER = struct.Struct('<4sQ')  # magic, sequencer session
+
+PLACE = 1
+CANCEL = 2
+CONFIGURE = 3
+PLACE_OWNED = 4
+CANCEL_ALL = 5
+CANCEL_INSTRUMENT = 6
+AMEND = 7
+EXPIRE = 8
+END_OF_DAY = 9
+
+AMEND_PRICE = 1
+AMEND_QUANTITY = 2
+
+SIDES = {'buy': 0, 'sell': 1, None: 2}
+SIDE_NAMES = ('buy', 'sell', None)
+# a place record's side byte carries the order type in its high nibble,
+# ICEBERG when the order has a display quantity and EXPIRES when it has an
+# expiry
+ORDER_TYPE_NAMES = ('limit', 'market', 'ioc', 'fok', 'post_only', 'stop', 'stop_limit')
+ORDER_TYPES = {name: code << 4 for code, name in enumerate(ORDER_TYPE_NAMES)}
+ICEBERG = 0x08
+EXPIRES = 0x04
+
+# kind, order_id, timestamp, price (ticks), quantity (lots), side, len(instrument); instrument follows.
+# PLACE_OWNED records are the same followed by len(owner) as one byte and the owner.
+# Stop and stop-limit orders then have their stop price (ticks) as STOP_PRICE,
+# icebergs their display quantity (lots) as DISPLAY, and orders that expire
+# end with their expire_at as EXPIRE_AT.
+PLACE_RECORD = struct.Struct('<BQqqqBB')
+STOP_PRICE = struct.Struct('<q')
+DISPLAY = struct.Struct('<q')
+EXPIRE_AT = struct.Struct('<q')
+STOP_TYPES = ORDER_TYPES['stop'], ORDER_TYPES['stop_limit']
+# kind, order_id
+CANCEL_RECORD = struct.Struct('<BQ')
+# kind, len(instrument), len(tick_size), len(lot_size); the three strings follow
+CONFIGURE_RECORD = struct.Struct('<BBBB')
+# kind, len(owner); owner follows
+CANCEL_ALL_RECORD = struct.Struct('<BB')
+# kind, side (2 for both), len(instrument); instrument follows
+CANCEL_INSTRUMENT_RECORD = struct.Struct('<BBB')
+# kind, order_id, AMEND_PRICE | AMEND_QUANTITY flags, price (ticks), quantity (lots)
+AMEND_RECORD = struct.Struct('<BQBqq')
+# kind, wall-clock time (time.time_ns()) expired up to
+EXPIRE_RECORD = struct.Struct('<Bq')
+# kind
+END_OF_DAY_RECORD = struct.Struct('<B')
+
+
+class Journal:
+    """Append-only binary log of the commands sent to a MatchingEngine.
+
+    Records are buffered and written with one write + fsync per group
+    commit: every `sync_every` records, or on the first record after
+    `sync_interval` seconds since the last commit, whichever comes first.
+    A commit only happens when a record arrives, so whoever acknowledges
+    commands calls flush() first: placeOrders() does at the end of every
+    batch, and so do the gateway and shard workers before they reply. A
+    crash can lose at most the unflushed group.
+    """
+
+    def __init__(self, path, session, sync_every=1024, sync_interval=0.002):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.buffer = bytearray()
+        self.pending = 0
+        self.commits = 0
+        self.lastCommit = time.monotonic()
+
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER.size:
+            with open(path, 'rb') as f:
+                magic, existing = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a matching engine journal")
+            if existing != session:
+                raise ValueError(f"{path} belongs to another engine session; replay() it first")
+            # drop a record torn by a crash, or the next ones land after its
+            # partial bytes and the journal no longer parses
+            with open(path, 'r+b') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    end, size = recordsEnd(buf), len(buf)
+                if end < size:
+                    f.truncate(end)
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, session))
+            self.commit()
+
+    def logPlace(self, order):
+        name = order.instrument.encode()
+        kind = PLACE if order.owner is None else PLACE_OWNED
+        side = SIDES[order.side] | ORDER_TYPES[order.order_type]
+        if order.display is not None:
+            side |= ICEBERG
+        if order.expire_at is not None:
+            side |= EXPIRES
+        self.buffer += PLACE_RECORD.pack(kind, order.order_id, order.timestamp, order.price, order.quantity, side,
+                                         len(name))
+        self.buffer += name
+        if order.owner is not None:
+            owner = order.owner.encode()
+            self.buffer.append(len(owner))
+            self.buffer += owner
+        if order.stop_price is not None:
+            self.buffer += STOP_PRICE.pack(order.stop_price)
+        if order.display is not None:
+            self.buffer += DISPLAY.pack(order.display)
+        if order.expire_at is not None:
+            self.buffer += EXPIRE_AT.pack(order.expire_at)
+        self.recorded()
+
+    def logAmend(self, order_id, price, quantity):
+        flags = (AMEND_PRICE if price is not None else 0) | (AMEND_QUANTITY if quantity is not None else 0)
+        self.buffer += AMEND_RECORD.pack(AMEND, order_id, flags, price or 0, quantity or 0)
+        self.recorded()
+
+    def logCancelAll(self, owner):
+        owner = owner.encode()
+        self.buffer += CANCEL_ALL_RECORD.pack(CANCEL_ALL, len(owner))
+        self.buffer += owner
+        self.recorded()
+
+    def logCancelInstrument(self, instrument, side):
+        name = instrument.encode()
+        self.buffer += CANCEL_INSTRUMENT_RECORD.pack(CANCEL_INSTRUMENT, SIDES[side], len(name))
+        self.buffer += name
+        self.recorded()
+
+    def logExpire(self, now):
+        self.buffer += EXPIRE_RECORD.pack(EXPIRE, now)
+        self.recorded()
+
+    def logEndOfDay(self):
+        self.buffer += END_OF_DAY_RECORD.pack(END_OF_DAY)
+        self.recorded()
+
+    def logCancel(self, order_id):
+        self.buffer += CANCEL_RECORD.pack(CANCEL, order_id)
+        self.recorded()
+
+    def logConfigure(self, instrument, tick_size, lot_size):
+        fields = [str(value).encode() for value in (instrument, tick_size, lot_size)]
+        self.buffer += CONFIGURE_RECORD.pack(CONFIGURE, *map(len, fields))
+        for field in fields:
+            self.buffer += field
+        self.recorded()
+
+    def recorded(self):
+        self.pending += 1
+        if self.pending >= self.sync_every or time.monotonic() - self.lastCommit >= self.sync_interval:
+            self.commit()
+
+    def flush(self):
+        """Commit whatever is buffered, so nothing acknowledged is left off disk while the engine is idle."""
+        if self.buffer:
+            self.commit()
+
+    def commit(self):
+        self.file.write(self.buffer)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.buffer.clear()
+        self.pending = 0
+        self.commits += 1
+        self.lastCommit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+
+def readHeader(buf, path):
+    magic, session = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a matching engine journal")
+    return session
+
+
+def iterRecords(buf, offset=None):
+    """Yield the journal's records in order.
+
+    Each record is (PLACE, order_id, instrument, side, price, quantity, timestamp, owner, order_type,
+    stop_price, display, expire_at),
+    (CANCEL, order_id), (CONFIGURE, instrument, tick_size, lot_size),
+    (CANCEL_ALL, owner), (CANCEL_INSTRUMENT, instrument, side),
+    (AMEND, order_id, price, quantity) with None for what is unchanged,
+    (EXPIRE, now) or (END_OF_DAY,). A torn
+    record at the end of the file (crash mid-write) ends the iteration;
+    the generator returns the offset the complete records end at.
+    """
+    names = {}
+    if offset is None:
+        offset = HEADER.size
+    end = len(buf)
+    unpack_place = PLACE_RECORD.unpack_from
+    place_size = PLACE_RECORD.size
+
+    while offset < end:
+        start = offset
+        kind = buf[offset]
+        if kind == PLACE or kind == PLACE_OWNED:
+            if offset + place_size > end:
+                return start
+            _, order_id, timestamp, price, quantity, side, length = unpack_place(buf, offset)
+            offset += place_size
+            if offset + length > end:
+                return start
+            raw = buf[offset:offset + length]
+            offset += length
+            instrument = names.get(raw)
+            if instrument is None:
+                instrument = names[raw] = raw.decode()
+            owner = None
+            if kind == PLACE_OWNED:
+                if offset >= end or offset + 1 + buf[offset] > end:
+                    return start
+                length = buf[offset]
+                owner = buf[offset + 1:offset + 1 + length].decode()
+                offset += 1 + length
+            stop_price = None
+            if side & 0xF0 in STOP_TYPES:
+                if offset + STOP_PRICE.size > end:
+                    return start
+                stop_price, = STOP_PRICE.unpack_from(buf, offset)
+                offset += STOP_PRICE.size
+            display = None
+            if side & ICEBERG:
+                if offset + DISPLAY.size > end:
+                    return start
+                display, = DISPLAY.unpack_from(buf, offset)
+                offset += DISPLAY.size
+            expire_at = None
+            if side & EXPIRES:
+                if offset + EXPIRE_AT.size > end:
+                    return start
+                expire_at, = EXPIRE_AT.unpack_from(buf, offset)
+                offset += EXPIRE_AT.size
+            yield (PLACE, order_id, instrument, SIDE_NAMES[side & 0x3], price, quantity, timestamp, owner,
+                   ORDER_TYPE_NAMES[side >> 4], stop_price, display, expire_at)
+        elif kind == CANCEL:
+            if offset + CANCEL_RECORD.size > end:
+                return start
+            _, order_id = CANCEL_RECORD.unpack_from(buf, offset)
+            offset += CANCEL_RECORD.size
+            yield CANCEL, order_id
+        elif kind == CONFIGURE:
+            if offset + CONFIGURE_RECORD.size > end:
+                return start
+            _, *lengths = CONFIGURE_RECORD.unpack_from(buf, offset)
+            offset += CONFIGURE_RECORD.size
+            if offset + sum(lengths) > end:
+                return start
+            fields = []
+            for length in lengths:
+                fields.append(buf[offset:offset + length].decode())
+                offset += length
+            yield (CONFIGURE, *fields)
+        elif kind == CANCEL_ALL:
+            if offset + CANCEL_ALL_RECORD.size > end:
+                return start
+            _, length = CANCEL_ALL_RECORD.unpack_from(buf, offset)
+            offset += CANCEL_ALL_RECORD.size
+            if offset + length > end:
+                return start
+            yield CANCEL_ALL, buf[offset:offset + length].decode()
+            offset += length
+        elif kind == CANCEL_INSTRUMENT:
+            if offset + CANCEL_INSTRUMENT_RECORD.size > end:
+                return start
+            _, side, length = CANCEL_INSTRUMENT_RECORD.unpack_from(buf, offset)
+            offset += CANCEL_INSTRUMENT_RECORD.size
+            if offset + length > end:
+                return start
+            yield CANCEL_INSTRUMENT, buf[offset:offset + length].decode(), SIDE_NAMES[side]
+            offset += length
+        elif kind == AMEND:
+            if offset + AMEND_RECORD.size > end:
+                return start
+            _, order_id, flags, price, quantity = AMEND_RECORD.unpack_from(buf, offset)
+            offset += AMEND_RECORD.size
+            yield (AMEND, order_id, price if flags & AMEND_PRICE else None,
+                   quantity if flags & AMEND_QUANTITY else None)
+        elif kind == EXPIRE:
+            if offset + EXPIRE_RECORD.size > end:
+                return start
+            _, now = EXPIRE_RECORD.unpack_from(buf, offset)
+            offset += EXPIRE_RECORD.size
+            yield EXPIRE, now
+        elif kind == END_OF_DAY:
+            offset += END_OF_DAY_RECORD.size
+            yield END_OF_DAY,
+        else:
+            raise ValueError(f"Corrupt journal record of kind {kind} at offset {offset}")
+    return offset
+
+
+def recordsEnd(buf, offset=None):
+    """Offset just past the last complete record, where appending may resume."""
+    records = iterRecords(buf, offset)
+    while True:
+        try:
+            next(records)
+        except StopIteration as done:
+            return done.value
+
+
+def replay(journal_path, batch_size=65536, eng=None, offset=None, **engine_kwargs):
+    """Rebuild a MatchingEngine from its journal.
+
+    Runs of consecutive place commands go through placeOrders in batches
+    with their journaled ids and timestamps, so the rebuilt books, trades
+    and order ids are identical to the original run. Events go to a
+    NullSink unless a `sink` is passed.
+
+    To recover from a snapshot, pass the restored engine as `eng` and the
+    journal `offset` the snapshot was taken at; only the commands after it
+    are applied.
+    """
+    engine_kwargs.setdefault('sink', events.NullSink())
+
+    with open(journal_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        session = readHeader(buf, journal_path)
+        if eng is None:
+            eng = engine.MatchingEngine(sequencer=engine.Sequencer(session=session), **engine_kwargs)
+        elif eng.sequencer.session != session:
+            raise ValueError(f"{journal_path} belongs to another engine session")
+        batch = engine.newBatch()
+        last_id = eng.sequencer.last
+
+        for record in iterRecords(buf, offset):
+            kind = record[0]
+            if kind == PLACE:
+                # place records carry their fields in engine.BATCH_COLUMNS order
+                for name, value in zip(engine.BATCH_COLUMNS, record[1:]):
+                    batch[name].append(value)
+                if record[1] > last_id:
+                    last_id = record[1]
+                if len(batch['order_id']) >= batch_size:
+                    eng.placeOrders(batch, scaled=True)
+                    batch = engine.newBatch()
+                continue
+
+            if batch['order_id']:
+                eng.placeOrders(batch, scaled=True)
+                batch = engine.newBatch()
+            if kind == CANCEL:
+                eng.cancelOrder(record[1])
+            elif kind == CANCEL_ALL:
+                eng.cancelAll(record[1])
+            elif kind == CANCEL_INSTRUMENT:
+                eng.cancelInstrument(*record[1:])
+            elif kind == AMEND:
+                _, order_id, price, quantity = record
+                eng.amendOrder(order_id, price, quantity, scaled=True)
+            elif kind == EXPIRE:
+                eng.expireOrders(record[1])
+            elif kind == END_OF_DAY:
+                eng.endOfDay()
+            else:
+                eng.configureInstrument(*record[1:])
+
+        if batch['order_id']:
+            eng.placeOrders(batch, scaled=True)
+
+        eng.sequencer = engine.Sequencer(start=last_id + 1, session=session)
+        return eng
+
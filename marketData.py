@@ -0,0 +1,68 @@
+from collections import namedtuple
+
+# Messages published to market data consumers. Prices are in ticks and
+# sizes in lots, like engine events; seq counts every message of one
+# instrument so a consumer can detect gaps and resync from a snapshot.
+DepthUpdate = namedtuple('DepthUpdate', 'instrument seq side price size')
+TopOfBook = namedtuple('TopOfBook', 'instrument seq bid_price bid_size ask_price ask_size')
+DepthSnapshot = namedtuple('DepthSnapshot', 'instrument seq bids asks')
+
+
+class InstrumentFeed:
+    def __init__(self):
+        self.seq = 0
+        self.top = (None, 0, None, 0)
+        self.sinceSnapshot = 0
+
+
+class MarketDataPublisher:
+    """Incremental L1/L2 market data for every book of a MatchingEngine.
+
+    Installed as the books' listener, it reads the books' aggregated depth
+    and calls `publish(message)` with a DepthUpdate each time a level's
+    size changes (add, fill or cancel), followed by a TopOfBook when the
+    best bid or ask moved. Every `snapshot_every` updates of an
+    instrument it also publishes a DepthSnapshot of the whole book, and
+    snapshot(instrument) builds one on demand for late joiners.
+    """
+
+    def __init__(self, eng, publish, snapshot_every=1000):
+        self.publish = publish
+        self.snapshot_every = snapshot_every
+        self.books = eng.orderbooks
+        self.feeds = {}
+
+        eng.orderbooks.addListener(self.levelChanged)
+        for book in list(eng.orderbooks.values()):
+            for order in book.restingOrders():
+                self.levelChanged(order, order.quantity)
+
+    def levelChanged(self, order, delta):
+        instrument = order.instrument
+        feed = self.feeds.get(instrument)
+        if feed is None:
+            feed = self.feeds[instrument] = InstrumentFeed()
+        book = self.books[instrument]
+
+        feed.seq += 1
+        self.publish(DepthUpdate(instrument, feed.seq, order.side, order.price,
+                                 book.levelSize(order.side, order.price)))
+
+        top = book.topOfBook()
+        if top != feed.top:
+            feed.top = top
+            feed.seq += 1
+            self.publish(TopOfBook(instrument, feed.seq, *top))
+
+        feed.sinceSnapshot += 1
+        if feed.sinceSnapshot >= self.snapshot_every:
+            self.publish(self.snapshot(instrument))
+
+    def snapshot(self, instrument, levels=None):
+        """Full (or top `levels`) depth of `instrument` at the current seq."""
+        feed = self.feeds.get(instrument)
+        if feed is None:
+            return DepthSnapshot(instrument, 0, [], [])
+        feed.sinceSnapshot = 0
+        bids, asks = self.books[instrument].depth(levels)
+        return DepthSnapshot(instrument, feed.seq, bids, asks)
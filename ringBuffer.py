@@ -0,0 +1,105 @@
+# Overflow policies for a consumer cursor
+OVERWRITE = 'overwrite'        # a slow consumer is skipped ahead; lost entries are counted as overruns
+BACKPRESSURE = 'backpressure'  # the publisher may not overwrite entries this consumer has not read
+
+
+class RingFullError(Exception):
+    pass
+
+
+class Cursor:
+    """Independent FIFO read position of one consumer on a RingBuffer."""
+
+    def __init__(self, ring, name, policy, position, on_full=None):
+        self.ring = ring
+        self.name = name
+        self.policy = policy
+        self.position = position
+        # BACKPRESSURE only: called with this cursor when the publisher is about
+        # to overwrite an unread entry, so the consumer can catch up inline
+        self.on_full = on_full
+        self.overruns = 0
+
+    def skipOverrun(self):
+        oldest = self.ring.head - self.ring.capacity
+        if self.position < oldest:
+            self.overruns += oldest - self.position
+            self.position = oldest
+
+    def poll(self):
+        """Next unread entry, or None when caught up."""
+        self.skipOverrun()
+        if self.position == self.ring.head:
+            return None
+        item = self.ring.slots[self.position % self.ring.capacity]
+        self.position += 1
+        return item
+
+    def drain(self, limit=None):
+        """All unread entries (at most `limit`) in publish order."""
+        self.skipOverrun()
+        end = self.ring.head if limit is None else min(self.ring.head, self.position + limit)
+        slots = self.ring.slots
+        capacity = self.ring.capacity
+        items = [slots[i % capacity] for i in range(self.position, end)]
+        self.position = end
+        return items
+
+    def __len__(self):
+        return min(self.ring.head - self.position, self.ring.capacity)
+
+    def __iter__(self):
+        item = self.poll()
+        while item is not None:
+            yield item
+            item = self.poll()
+
+
+class RingBuffer:
+    """Preallocated, bounded FIFO with one read cursor per consumer.
+
+    Publishing never allocates. Entries stay in their slot until the writer
+    wraps around to them; each consumer (risk, drop-copy, GUI, ...) reads at
+    its own pace through a named Cursor with its own overflow policy.
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.head = 0  # sequence number of the next entry to publish
+        self.cursors = {}
+        self.backpressured = []
+        self.highWaterMark = 0
+
+    def cursor(self, name, policy=OVERWRITE, on_full=None):
+        """Cursor called `name`, created at the oldest retained entry on first use."""
+        cursor = self.cursors.get(name)
+        if cursor is None:
+            cursor = Cursor(self, name, policy, max(0, self.head - self.capacity), on_full)
+            self.cursors[name] = cursor
+            if policy == BACKPRESSURE:
+                self.backpressured.append(cursor)
+        return cursor
+
+    def append(self, item):
+        head = self.head
+        overwritten = head - self.capacity
+        for cursor in self.backpressured:
+            if cursor.position <= overwritten:
+                if cursor.on_full is not None:
+                    cursor.on_full(cursor)
+                if cursor.position <= overwritten:
+                    raise RingFullError(f"consumer {cursor.name!r} has {len(cursor)} unread entries")
+
+        self.slots[head % self.capacity] = item
+        self.head = head + 1
+
+        if self.cursors:
+            depth = self.head - min(cursor.position for cursor in self.cursors.values())
+        else:
+            depth = self.head
+        if depth > self.highWaterMark:
+            self.highWaterMark = min(depth, self.capacity)
+
+    def __len__(self):
+        return min(self.head, self.capacity)
@@ -0,0 +1,175 @@
+import MatchingEngine as engine
+import events
+from ringBuffer import BACKPRESSURE
+
+
+class Account:
+    """Incrementally maintained exposure of one owner.
+
+    openNotional is the quote-currency value of the owner's resting orders,
+    openBuys/openSells their resting lots per instrument, and positions the
+    net lots bought per instrument.
+    """
+
+    __slots__ = ('openNotional', 'openBuys', 'openSells', 'positions')
+
+    def __init__(self):
+        self.openNotional = 0.0
+        self.openBuys = {}
+        self.openSells = {}
+        self.positions = {}
+
+
+class RiskCheck:
+    """Pre-trade checks run by MatchingEngine before an order is journaled or matched.
+
+    Limits, in the instrument's decimal units:
+      max_order_size     largest quantity of a single order
+      price_band         largest distance of a limit price from the last
+                         trade (or the mid if nothing traded), as a fraction
+      max_open_notional  per owner: value of resting orders plus the new one
+      max_position       per owner and instrument: net position if every
+                         resting order on the new order's side filled
+    account_limits maps an owner to its own max_open_notional / max_position.
+    Orders without an owner only get the order-level checks.
+
+    Resting exposure follows the books through a book listener and positions
+    follow the ack queues through backpressured cursors, so each check is
+    O(1) plus the fills since the previous one.
+    """
+
+    def __init__(self, eng, max_order_size=None, price_band=None, max_open_notional=None, max_position=None,
+                 account_limits=None):
+        self.eng = eng
+        self.max_order_size = max_order_size
+        self.price_band = price_band
+        self.max_open_notional = max_open_notional
+        self.max_position = max_position
+        self.account_limits = dict(account_limits or {})
+        self.accounts = {}
+        self.reserves = {}  # order_id -> hidden quantity of an owned iceberg, as last counted
+        self.scales = {}  # instrument -> (quote value of 1 tick x 1 lot, lots per unit of quantity)
+
+        self.fills = []
+        for ring in (eng.buyerAckQueue, eng.sellerAckQueue):
+            cursor = ring.cursor('risk', BACKPRESSURE, on_full=self.applyFills)
+            cursor.position = ring.head  # only fills from now on
+            self.fills.append(cursor)
+        eng.orderbooks.addListener(self.levelChanged)
+        for book in list(eng.orderbooks.values()):
+            for order in book.restingOrders():
+                self.levelChanged(order, order.quantity)
+
+    def scale(self, instrument):
+        scale = self.scales.get(instrument)
+        if scale is None:
+            spec = self.eng.spec(instrument)
+            scale = self.scales[instrument] = (float(spec.tick_size * spec.lot_size), 1 / float(spec.lot_size))
+        return scale
+
+    def account(self, owner):
+        account = self.accounts.get(owner)
+        if account is None:
+            account = self.accounts[owner] = Account()
+        return account
+
+    def levelChanged(self, order, delta):
+        if order.owner is None:
+            return
+        if order.display is not None:
+            # the books only report an iceberg's shown clip; count its reserve too
+            delta += order.hidden - self.reserves.pop(order.order_id, 0)
+            if order.hidden:
+                self.reserves[order.order_id] = order.hidden
+        account = self.account(order.owner)
+        account.openNotional += delta * order.price * self.scale(order.instrument)[0]
+        open_lots = account.openBuys if order.side == 'buy' else account.openSells
+        open_lots[order.instrument] = open_lots.get(order.instrument, 0) + delta
+
+    def applyFills(self, cursor=None):
+        for fills in self.fills:
+            for matched in fills.drain():
+                if matched.owner is None:
+                    continue
+                positions = self.account(matched.owner).positions
+                signed = matched.filled_quantity if matched.side == 'buy' else -matched.filled_quantity
+                positions[matched.instrument] = positions.get(matched.instrument, 0) + signed
+
+    def referencePrice(self, instrument):
+        tape = self.eng.trades.get(instrument)
+        if tape is not None and tape.lastPrice is not None:
+            return tape.lastPrice
+        book = self.eng.orderbooks.get(instrument)
+        if book is not None:
+            bid, _, ask, _ = book.topOfBook()
+            if bid is not None and ask is not None:
+                return (bid + ask) / 2
+        return None
+
+    def limit(self, owner, name):
+        limits = self.account_limits.get(owner)
+        if limits is not None and name in limits:
+            return limits[name]
+        return getattr(self, name)
+
+    def check(self, order, replaced=None):
+        """Reject reason for `order`, or None if it may go ahead.
+
+        For an amend, `replaced` is the resting order being changed; its
+        current exposure is not counted twice.
+        """
+        instrument = order.instrument
+        notional_scale, lots_per_unit = self.scale(instrument)
+        if self.max_order_size is not None and order.quantity > self.max_order_size * lots_per_unit:
+            return events.ORDER_TOO_LARGE
+
+        market = order.order_type == engine.MARKET or order.order_type == engine.STOP
+        reference = None
+        if self.price_band is not None and not market:
+            reference = self.referencePrice(instrument)
+            if reference is not None and abs(order.price - reference) > self.price_band * abs(reference):
+                return events.OUTSIDE_PRICE_BAND
+
+        owner = order.owner
+        if owner is None:
+            return None
+        account = self.account(owner)
+
+        max_open_notional = self.limit(owner, 'max_open_notional')
+        if max_open_notional is not None:
+            price = order.price
+            if market:
+                price = self.referencePrice(instrument) or 0
+            notional = account.openNotional + order.quantity * price * notional_scale
+            if replaced is not None:
+                notional -= (replaced.quantity + replaced.hidden) * replaced.price * notional_scale
+            if notional > max_open_notional:
+                return events.NOTIONAL_LIMIT
+
+        max_position = self.limit(owner, 'max_position')
+        if max_position is not None:
+            self.applyFills()
+            position = account.positions.get(instrument, 0)
+            pending = order.quantity - (replaced.quantity + replaced.hidden if replaced is not None else 0)
+            if order.side == 'buy':
+                worst = position + account.openBuys.get(instrument, 0) + pending
+            else:
+                worst = -position + account.openSells.get(instrument, 0) + pending
+            if worst > max_position * lots_per_unit:
+                return events.POSITION_LIMIT
+        return None
+
+    def exposure(self, owner):
+        """Open notional, and per instrument position and resting buy/sell quantity, in decimal units."""
+        self.applyFills()
+        account = self.accounts.get(owner) or Account()
+        instruments = set(account.positions) | set(account.openBuys) | set(account.openSells)
+        result = {"open_notional": account.openNotional, "instruments": {}}
+        for instrument in instruments:
+            spec = self.eng.spec(instrument)
+            result["instruments"][instrument] = {
+                "position": spec.fromLots(account.positions.get(instrument, 0)),
+                "open_buys": spec.fromLots(account.openBuys.get(instrument, 0)),
+                "open_sells": spec.fromLots(account.openSells.get(instrument, 0)),
+            }
+        return result
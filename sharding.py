@@ -0,0 +1,275 @@
+import multiprocessing
+import time
+import zlib
+
+import MatchingEngine as engine
+import events
+from ringBuffer import RingBuffer
+
+PLACE = 'place'
+CANCEL = 'cancel'
+CANCEL_ALL = 'cancelAll'
+CANCEL_INSTRUMENT = 'cancelInstrument'
+AMEND = 'amend'
+EXPIRE = 'expire'
+END_OF_DAY = 'endOfDay'
+
+
+def shardWorker(conn, engine_kwargs):
+    """Run one MatchingEngine, applying command batches sent by the ShardRouter.
+
+    Every batch is answered with the events, buy acks and sell acks it
+    produced and the ids of the orders those events left filled or off the
+    book; every ('call', method, args) with the method's return value.
+    Place commands arrive already checked and scaled by the router. Any
+    other command the engine refuses (an amend to an off-grid price, say)
+    becomes a REJECT event, so one bad command never takes the shard down.
+    """
+    collected = []
+    eng = engine.MatchingEngine(sink=events.CallbackSink(collected.append), **engine_kwargs)
+    buy_acks = eng.buyerAckQueue.cursor('router')
+    sell_acks = eng.sellerAckQueue.cursor('router')
+    commands = {CANCEL: eng.cancelOrder, CANCEL_ALL: eng.cancelAll, CANCEL_INSTRUMENT: eng.cancelInstrument,
+                AMEND: eng.amendOrder, EXPIRE: eng.expireOrders, END_OF_DAY: eng.endOfDay}
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        if message[0] == 'call':
+            _, method, args = message
+            try:
+                conn.send(('result', getattr(eng, method)(*args)))
+            except Exception as e:
+                conn.send(('error', e))
+            continue
+
+        batch = None
+        for command in message[1]:
+            if command[0] == PLACE:
+                if batch is None:
+                    batch = engine.newBatch()
+                # place commands carry their fields in engine.BATCH_COLUMNS order
+                for name, value in zip(engine.BATCH_COLUMNS, command[1:]):
+                    batch[name].append(value)
+            else:
+                if batch is not None:
+                    eng.placeOrders(batch, scaled=True)
+                    batch = None
+                try:
+                    commands[command[0]](*command[1:])
+                except (ValueError, ArithmeticError) as e:
+                    order_id = command[1] if command[0] in (CANCEL, AMEND) else None
+                    collected.append(events.Event(events.REJECT, order_id, None, None, None, 0, 0, None, str(e)))
+        if batch is not None:
+            eng.placeOrders(batch, scaled=True)
+        if eng.journal is not None:
+            eng.journal.flush()
+
+        done = []
+        for order_id in {event.order_id for event in collected}:
+            order = eng.orders.get(order_id)
+            if order is None or order.quantity == 0:
+                done.append(order_id)
+        conn.send(('events', collected[:], buy_acks.drain(), sell_acks.drain(), done))
+        collected.clear()
+
+
+class ShardRouter:
+    """Front-end that spreads instruments over worker processes.
+
+    Each worker runs its own MatchingEngine. An instrument lives on the shard
+    given by `partition` (instrument -> shard index) or, failing that, on
+    crc32(instrument) % workers. Order ids are assigned here, so placeOrder
+    returns without waiting for the worker: commands are queued per shard
+    and sent in batches of `batch_size` (or on flush()). Cancels are routed
+    through the order_id -> shard map; cancelAll(owner), expireOrders() and
+    endOfDay() go to every shard.
+
+    Events and acks coming back from the shards are merged into this
+    router's `sink`, buyerAckQueue and sellerAckQueue. Order across shards
+    follows arrival; within a shard it is the engine's own order.
+
+    At most one batch per shard is in flight: the next one is only sent
+    once the shard has answered, so a shard blocked writing a large reply
+    never waits on a router blocked writing the next batch. An order's
+    entry in the order_id -> shard map is dropped once its shard reports it
+    filled or off the book.
+
+    placeOrder checks and scales orders here, against the specs set with
+    configureInstrument (or the engines' default_spec), and raises
+    ValueError like MatchingEngine.placeOrder does, so the workers only ever
+    see valid orders.
+    """
+
+    def __init__(self, workers=None, partition=None, batch_size=256, sink=None, ack_capacity=65536,
+                 **engine_kwargs):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.partition = dict(partition or {})
+        self.batch_size = batch_size
+        self.sink = sink if sink is not None else events.NullSink()
+        self.buyerAckQueue = RingBuffer(ack_capacity)
+        self.sellerAckQueue = RingBuffer(ack_capacity)
+        self.sequencer = engine.Sequencer()
+        self.default_spec = engine_kwargs.get('default_spec') or engine.InstrumentSpec()
+        self.instruments = {}
+        self.shardOf = {}
+        self.shards = {}
+        self.pending = [[] for _ in range(self.workers)]
+        self.inFlight = [0] * self.workers
+
+        self.conns = []
+        self.processes = []
+        for _ in range(self.workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shardWorker, args=(child, engine_kwargs), daemon=True)
+            process.start()
+            child.close()
+            self.conns.append(parent)
+            self.processes.append(process)
+
+    def shard(self, instrument):
+        shard = self.shards.get(instrument)
+        if shard is None:
+            shard = self.partition.get(instrument)
+            if shard is None:
+                shard = zlib.crc32(instrument.encode()) % self.workers
+            self.shards[instrument] = shard
+        return shard
+
+    def spec(self, instrument):
+        return self.instruments.get(instrument, self.default_spec)
+
+    def placeOrder(self, instrument, side, price, quantity, owner=None, order_type=engine.LIMIT, stop_price=None,
+                   display_quantity=None, expire_at=None):
+        if order_type not in engine.ORDER_TYPES:
+            raise ValueError(f"Unknown order type {order_type!r}")
+        if side not in ('buy', 'sell'):
+            raise ValueError(f"Unknown side {side!r}")
+        spec = self.spec(instrument)
+        price = None if order_type in (engine.MARKET, engine.STOP) else spec.toTicks(price)
+        if order_type in engine.TRIGGERED_TYPES:
+            if stop_price is None:
+                raise ValueError(f"A {order_type} order needs a stop price")
+            stop_price = spec.toTicks(stop_price)
+        else:
+            stop_price = None
+        quantity = spec.toLots(quantity)
+        if display_quantity is not None:
+            display_quantity = engine.icebergDisplay(order_type, quantity, spec.toLots(display_quantity))
+        engine.orderExpiry(order_type, expire_at)
+        shard = self.shard(instrument)
+        order_id = self.sequencer.next()
+        self.shardOf[order_id] = shard
+        self.queue(shard, (PLACE, order_id, instrument, side, price, quantity, time.monotonic_ns(), owner,
+                           order_type, stop_price, display_quantity, expire_at))
+        return order_id
+
+    def cancelOrder(self, order_id):
+        shard = self.shardOf.pop(order_id, None)
+        if shard is None:
+            self.sink.emit(events.Event(events.REJECT, order_id, None, None, None, 0, 0, None,
+                                        events.NO_SUCH_ORDER))
+            return
+        self.queue(shard, (CANCEL, order_id))
+
+    def amendOrder(self, order_id, new_price=None, new_qty=None):
+        shard = self.shardOf.get(order_id)
+        if shard is None:
+            self.sink.emit(events.Event(events.REJECT, order_id, None, None, None, 0, 0, None,
+                                        events.NO_SUCH_ORDER))
+            return
+        self.queue(shard, (AMEND, order_id, new_price, new_qty))
+
+    def cancelAll(self, owner):
+        for shard in range(self.workers):
+            self.queue(shard, (CANCEL_ALL, owner))
+
+    def expireOrders(self, now=None):
+        # one wall-clock reading for every shard, the clock expire_at values are on
+        now = time.time_ns() if now is None else now
+        for shard in range(self.workers):
+            self.queue(shard, (EXPIRE, now))
+
+    def endOfDay(self):
+        for shard in range(self.workers):
+            self.queue(shard, (END_OF_DAY,))
+
+    def cancelInstrument(self, instrument, side=None):
+        self.queue(self.shard(instrument), (CANCEL_INSTRUMENT, instrument, side))
+
+    def cancelSide(self, instrument, side):
+        self.cancelInstrument(instrument, side)
+
+    def queue(self, shard, command):
+        pending = self.pending[shard]
+        pending.append(command)
+        if len(pending) >= self.batch_size:
+            self.send(shard)
+
+    def send(self, shard):
+        self.collect(shard, wait=True)
+        self.conns[shard].send(('batch', self.pending[shard]))
+        self.pending[shard] = []
+        self.inFlight[shard] += 1
+
+    def flush(self):
+        """Send every queued command and wait until all shards have applied them."""
+        for shard in range(self.workers):
+            if self.pending[shard]:
+                self.send(shard)
+        for shard in range(self.workers):
+            self.collect(shard, wait=True)
+
+    def collect(self, shard, wait=False):
+        conn = self.conns[shard]
+        while self.inFlight[shard] and (wait or conn.poll()):
+            self.receive(conn.recv(), shard)
+
+    def receive(self, message, shard):
+        kind = message[0]
+        if kind != 'events':
+            raise RuntimeError(f"unexpected {kind!r} reply from shard {shard}")
+        _, shard_events, buy_acks, sell_acks, done = message
+        self.inFlight[shard] -= 1
+        shard_of = self.shardOf
+        for order_id in done:
+            shard_of.pop(order_id, None)
+        emit = self.sink.emit
+        for event in shard_events:
+            emit(event)
+        for ack in buy_acks:
+            self.buyerAckQueue.append(ack)
+        for ack in sell_acks:
+            self.sellerAckQueue.append(ack)
+
+    def call(self, instrument, method, *args):
+        """Call `method` on the engine owning `instrument` once its queued commands are applied."""
+        shard = self.shard(instrument)
+        if self.pending[shard]:
+            self.send(shard)
+        self.collect(shard, wait=True)
+        self.conns[shard].send(('call', method, args))
+        kind, value = self.conns[shard].recv()
+        if kind == 'error':
+            raise value
+        return value
+
+    def configureInstrument(self, instrument, tick_size, lot_size):
+        self.call(instrument, 'configureInstrument', instrument, tick_size, lot_size)
+        self.instruments[instrument] = engine.InstrumentSpec(tick_size, lot_size)
+
+    def getOrderBook(self, instrument):
+        return self.call(instrument, 'getOrderBook', instrument)
+
+    def getTrades(self, instrument):
+        return self.call(instrument, 'getTrades', instrument)
+
+    def close(self):
+        self.flush()
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        for conn in self.conns:
+            conn.close()
@@ -0,0 +1,250 @@
+from array import array
+import bisect
+import mmap
+import struct
+
+import MatchingEngine as engine
+import journal
+
+MAGIC = b'MES1'
+VERSION = 7
+# magic, version, session, last order id, journal offset (-1 if none), order count, instrument count,
+# owner count
+HEADER = struct.Struct('<4sHxxQQqQII')
+# first row, row count, last trade price (ticks), whether there was a trade, len(name), len(tick_size),
+# len(lot_size); the strings follow. New stops trigger off the last trade price.
+INSTRUMENT = struct.Struct('<QQqBHBB')
+# len(owner); the owner follows. Owners are listed after the instruments.
+OWNER = struct.Struct('<H')
+
+# One int64 column per field, each `order count` long, in this order. Rows
+# are grouped by instrument and in priority order within it (bids best
+# first, then asks, then untriggered stops in trigger order), so a book is
+# rebuilt by adding its rows in sequence, which hands out time priority
+# (see OrderBook.add) in the same order. `owner` indexes the owner list
+# (-1 for none), `order_type` indexes journal.ORDER_TYPE_NAMES,
+# `stop_price` is 0 unless it is a stop type, `display` (0 unless an
+# iceberg) and `hidden` are an iceberg's clip size and reserve, and
+# `expire_at` is 0 unless the order expires. `by_id` holds row numbers
+# sorted by order id, for lookups by id.
+COLUMNS = ('order_id', 'timestamp', 'price', 'quantity', 'filled_quantity', 'side', 'owner', 'order_type',
+           'stop_price', 'display', 'hidden', 'expire_at', 'by_id')
+ORDER_TYPES = {name: code for code, name in enumerate(journal.ORDER_TYPE_NAMES)}
+
+SIDES = {'buy': 0, 'sell': 1}
+SIDE_NAMES = ('buy', 'sell')
+
+
+def padding(size):
+    return -size % 8
+
+
+def writeSnapshot(eng, path):
+    if eng.snapshotLoader is not None:
+        eng.snapshotLoader.materializeAll()
+
+    journal_offset = -1
+    if eng.journal is not None:
+        eng.journal.commit()
+        journal_offset = eng.journal.file.tell()
+
+    columns = {name: array('q') for name in COLUMNS}
+    table = bytearray()
+    owners = {}
+    names = sorted(set(eng.orderbooks) | set(eng.instruments) | set(eng.stopBooks))
+
+    for instrument in names:
+        first_row = len(columns['order_id'])
+        book = eng.orderbooks.get(instrument)
+        orders = book.restingOrders() if book is not None else []
+        if instrument in eng.stopBooks:
+            orders += eng.stopBooks[instrument].orders()
+        for order in orders:
+            columns['order_id'].append(order.order_id)
+            columns['timestamp'].append(order.timestamp)
+            columns['price'].append(order.price)
+            columns['quantity'].append(order.quantity)
+            columns['filled_quantity'].append(order.filled_quantity)
+            columns['side'].append(SIDES[order.side])
+            columns['owner'].append(-1 if order.owner is None else owners.setdefault(order.owner, len(owners)))
+            columns['order_type'].append(ORDER_TYPES[order.order_type])
+            columns['stop_price'].append(order.stop_price or 0)
+            columns['display'].append(order.display or 0)
+            columns['hidden'].append(order.hidden)
+            columns['expire_at'].append(order.expire_at or 0)
+
+        spec = eng.instruments.get(instrument)
+        fields = [instrument.encode()]
+        fields += [str(spec.tick_size).encode(), str(spec.lot_size).encode()] if spec else [b'', b'']
+        tape = eng.trades.get(instrument)
+        last_price = tape.lastPrice if tape is not None else None
+        table += INSTRUMENT.pack(first_row, len(columns['order_id']) - first_row, last_price or 0,
+                                 last_price is not None, *map(len, fields))
+        for field in fields:
+            table += field
+
+    for owner in owners:
+        owner = owner.encode()
+        table += OWNER.pack(len(owner))
+        table += owner
+
+    ids = columns['order_id']
+    columns['by_id'] = array('q', sorted(range(len(ids)), key=ids.__getitem__))
+    table += bytes(padding(len(table)))
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, eng.sequencer.session, eng.sequencer.last, journal_offset,
+                            len(ids), len(names), len(owners)))
+        f.write(table)
+        for name in COLUMNS:
+            f.write(columns[name].tobytes())
+
+
+class SnapshotLoader:
+    """Memory-mapped snapshot whose books are only parsed when first used."""
+
+    def __init__(self, path, eng, buf, rows, starts, names, owners, columns):
+        self.path = path
+        self.eng = eng
+        self.buf = buf
+        self.rows = rows  # instrument -> (first row, row count), for books not yet rebuilt
+        self.starts = starts
+        self.names = names
+        self.owners = owners
+        self.columns = columns
+
+    def materialize(self, instrument, book):
+        span = self.rows.pop(instrument, None)
+        if span is None:
+            return
+        first, count = span
+        end = first + count
+        (ids, timestamps, prices, quantities, filled, sides, owner_ids, types, stop_prices, displays, hidden,
+         expiries) = (self.columns[name][first:end].tolist() for name in COLUMNS[:12])
+
+        orders = self.eng.orders
+        owners = self.owners
+        stops = None
+        for i in range(count):
+            owner = None if owner_ids[i] < 0 else owners[owner_ids[i]]
+            order_type = journal.ORDER_TYPE_NAMES[types[i]]
+            order = engine.Order(instrument, ids[i], SIDE_NAMES[sides[i]], prices[i], quantities[i],
+                                 timestamps[i], owner, order_type)
+            order.filled_quantity = filled[i]
+            if displays[i]:
+                order.display = displays[i]
+                order.hidden = hidden[i]
+            if expiries[i]:
+                order.expire_at = expiries[i]
+                self.eng.scheduleExpiry(order)
+            if order_type in engine.TRIGGERED_TYPES:
+                order.stop_price = stop_prices[i]
+                if stops is None:
+                    stops = self.eng.stopBooks.setdefault(instrument, engine.StopBook())
+                stops.add(order)
+            else:
+                book.add(order)
+            orders[order.order_id] = order
+            if owner is not None:
+                self.eng.ownerOrders[owner][order.order_id] = order
+
+        if not self.rows:
+            self.close()
+
+    def materializeAll(self):
+        for instrument in list(self.rows):
+            self.eng.orderbooks[instrument]
+
+    def lookup(self, order_id):
+        # binary search the by_id column without touching any other row
+        ids = self.columns['order_id']
+        by_id = self.columns['by_id']
+        lo, hi = 0, len(by_id)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ids[by_id[mid]] < order_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(by_id) or ids[by_id[lo]] != order_id:
+            return None
+
+        instrument = self.names[bisect.bisect_right(self.starts, by_id[lo]) - 1]
+        if instrument in self.rows:
+            self.eng.orderbooks[instrument]
+        return self.eng.orders.get(order_id)
+
+    def close(self):
+        for view in self.columns.values():
+            view.release()
+        self.buf.close()
+        self.eng.snapshotLoader = None
+        self.eng.orderbooks.loader = None
+
+
+def loadSnapshot(path, **engine_kwargs):
+    """MatchingEngine restored from a snapshot written by MatchingEngine.snapshot().
+
+    Only the header and instrument table are read up front. Each book is
+    rebuilt from the mapped columns the first time it is used, and a cancel
+    of a not-yet-rebuilt order finds its book through the by_id column.
+
+    With `journal_path`, commands journaled after the snapshot was taken are
+    replayed on top and the journal stays open for appending.
+    """
+    journal_path = engine_kwargs.pop('journal_path', None)
+
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, session, last_id, journal_offset, count, n_instruments, n_owners = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        buf.close()
+        raise ValueError(f"{path} is not a matching engine snapshot")
+
+    eng = engine.MatchingEngine(sequencer=engine.Sequencer(start=last_id + 1, session=session), **engine_kwargs)
+
+    offset = HEADER.size
+    rows, starts, names = {}, [], []
+    for _ in range(n_instruments):
+        first, row_count, last_price, traded, *lengths = INSTRUMENT.unpack_from(buf, offset)
+        offset += INSTRUMENT.size
+        fields = []
+        for length in lengths:
+            fields.append(buf[offset:offset + length].decode())
+            offset += length
+        instrument, tick_size, lot_size = fields
+        if tick_size:
+            eng.instruments[instrument] = engine.InstrumentSpec(tick_size, lot_size)
+        if traded:
+            eng.trades[instrument].lastPrice = last_price
+        if row_count:
+            rows[instrument] = (first, row_count)
+            starts.append(first)
+            names.append(instrument)
+    owners = []
+    for _ in range(n_owners):
+        length, = OWNER.unpack_from(buf, offset)
+        offset += OWNER.size
+        owners.append(buf[offset:offset + length].decode())
+        offset += length
+    offset += padding(offset)
+
+    view = memoryview(buf)
+    columns = {}
+    for name in COLUMNS:
+        columns[name] = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+    view.release()
+
+    loader = SnapshotLoader(path, eng, buf, rows, starts, names, owners, columns)
+    eng.orderbooks.loader = loader
+    if rows:
+        eng.snapshotLoader = loader
+    else:
+        loader.close()
+
+    if journal_path is not None:
+        journal.replay(journal_path, eng=eng, offset=journal_offset if journal_offset >= 0 else None)
+        eng.openJournal(journal_path)
+    return eng
@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+import MatchingEngine as engine
+import events
+from ringBuffer import BACKPRESSURE, RingFullError
+from test_journal import BOOKS
+
+
+def newEngine(book_factory, **kwargs):
+    return engine.MatchingEngine(book_factory, sink=events.NullSink(), default_spec=engine.InstrumentSpec(1, 1),
+                                 **kwargs)
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_full_ack_queue_refuses_the_next_order_not_the_match(book_factory):
+    eng = newEngine(book_factory, ack_capacity=2)
+    dropcopy = eng.sellerAckQueue.cursor('dropcopy', BACKPRESSURE)
+    makers = [eng.placeOrder('X', 'sell', 100, 1) for _ in range(3)]
+
+    # the sweep completes even though only two of its three sell acks fit
+    taker = eng.placeOrder('X', 'buy', 100, 3)
+    assert eng.orders[taker].filled_quantity == 3
+    assert eng.orderbooks['X'].restingOrders() == []
+    assert [trade.volume for trade in eng.getTrades('X')] == [1, 1, 1]
+
+    last_id = eng.sequencer.last
+    with pytest.raises(RingFullError):
+        eng.placeOrder('X', 'buy', 100, 1)
+    assert eng.sequencer.last == last_id
+
+    assert [ack.order_id for ack in dropcopy.drain()] == makers[:2]
+    eng.placeOrder('X', 'buy', 100, 1)
+    assert [ack.order_id for ack in dropcopy.drain()] == makers[2:]
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_trades_are_stamped_when_they_execute(book_factory):
+    eng = newEngine(book_factory)
+    bid = eng.placeOrder('X', 'buy', 99, 1)
+    eng.placeOrder('X', 'sell', 101, 2)
+    eng.placeOrder('X', 'buy', 101, 1)
+    eng.amendOrder(bid, 101)
+
+    first, second = eng.getTrades('X')
+    assert second.id == bid
+    assert second.timestamp >= first.timestamp > eng.orders[bid].timestamp
+
+
+def test_good_till_time_is_on_the_wall_clock():
+    eng = newEngine(engine.PriceLevelBook)
+    due = eng.placeOrder('X', 'buy', 99, 1, expire_at=time.time_ns() - 1)
+    eng.placeOrder('X', 'buy', 98, 1, expire_at=time.time_ns() + 60 * 10**9)
+
+    assert eng.expireOrders() == [due]
+
+
+@pytest.mark.parametrize('mode', engine.SELF_TRADE_MODES)
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_fok_is_killed_before_self_trade_prevention_touches_the_book(book_factory, mode):
+    eng = newEngine(book_factory, self_trade=mode)
+    own = eng.placeOrder('X', 'sell', 100, 5, owner='desk')
+    eng.placeOrder('X', 'sell', 101, 5, owner='other')
+
+    fok = eng.placeOrder('X', 'buy', 101, 10, owner='desk', order_type=engine.FOK)
+    assert eng.orders.get(fok) is None
+    assert eng.getTrades('X') == []
+    assert [(o.order_id, o.quantity) for o in eng.orderbooks['X'].restingOrders()][0] == (own, 5)
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_fok_fills_past_own_orders_it_cancels(book_factory):
+    eng = newEngine(book_factory, self_trade=engine.CANCEL_RESTING)
+    eng.placeOrder('X', 'sell', 100, 5, owner='desk')
+    eng.placeOrder('X', 'sell', 101, 10, owner='other')
+
+    fok = eng.placeOrder('X', 'buy', 101, 10, owner='desk', order_type=engine.FOK)
+    assert eng.orders[fok].filled_quantity == 10
+    assert eng.orderbooks['X'].restingOrders() == []
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_a_bad_row_rejects_the_batch_before_any_of_it_is_placed(book_factory):
+    eng = engine.MatchingEngine(book_factory, sink=events.NullSink(), default_spec=engine.InstrumentSpec('0.01', 1))
+    last_id = eng.sequencer.last
+    batch = {'instrument': ['X', 'X', 'X'], 'side': ['sell', 'buy', 'buy'], 'price': ['100', '100', '100.001'],
+             'quantity': ['1', '1', '1']}
+    with pytest.raises(ValueError):
+        eng.placeOrders(batch)
+
+    assert eng.orderbooks['X'].restingOrders() == []
+    assert eng.getTrades('X') == []
+    assert eng.sequencer.last == last_id
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_self_trade_modes(book_factory):
+    def run(mode):
+        eng = newEngine(book_factory, self_trade=mode)
+        eng.placeOrder('X', 'sell', 100, 2, owner='other')
+        own = eng.placeOrder('X', 'sell', 100, 3, owner='desk')
+        eng.placeOrder('X', 'sell', 101, 4, owner='other')
+        taker = eng.placeOrder('X', 'buy', 101, 6, owner='desk')
+        resting = [(o.order_id == own, o.price, o.quantity) for o in eng.orderbooks['X'].restingOrders()]
+        return [trade.volume for trade in eng.getTrades('X')], eng.orders[taker].quantity, resting
+
+    # the sweep cancels the own order and goes on
+    assert run(engine.CANCEL_RESTING) == ([2, 4], 0, [])
+    # the rest of the incoming order is cancelled, the own order keeps its place
+    assert run(engine.CANCEL_AGGRESSOR) == ([2], 0, [(True, 100, 3), (False, 101, 4)])
+    # both lose the 3 that would have traded
+    assert run(engine.DECREMENT) == ([2, 1], 0, [(False, 101, 3)])
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_fok_counts_iceberg_reserves(book_factory):
+    eng = newEngine(book_factory)
+    iceberg = eng.placeOrder('X', 'sell', 100, 10, display_quantity=1)
+    eng.placeOrder('X', 'sell', 101, 1)
+    assert eng.orderbooks['X'].depth() == ([], [(100, 1), (101, 1)])
+
+    fok = eng.placeOrder('X', 'buy', 100, 5, order_type=engine.FOK)
+    assert eng.orders[fok].filled_quantity == 5
+    assert eng.placeOrder('X', 'buy', 101, 7, order_type=engine.FOK) not in eng.orders
+    fok = eng.placeOrder('X', 'buy', 101, 6, order_type=engine.FOK)
+    assert eng.orders[fok].filled_quantity == 6
+    assert eng.orders[iceberg].quantity + eng.orders[iceberg].hidden == 0
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import MatchingEngine as engine
+import events
+import gateway
+
+
+async def request(reader, writer, message):
+    writer.write((message if isinstance(message, str) else json.dumps(message)).encode() + b'\n')
+    return json.loads(await asyncio.wait_for(reader.readline(), 5))
+
+
+async def badRequestsAreRejected():
+    eng = engine.MatchingEngine(engine.PriceLevelBook, sink=events.NullSink(),
+                                default_spec=engine.InstrumentSpec(1, 1))
+    gw = gateway.Gateway(eng, batch_interval=0)
+    batcher = asyncio.ensure_future(gw.runBatches())
+    server = await asyncio.start_server(gw.handleClient, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        bad_reader, bad_writer = await asyncio.open_connection('127.0.0.1', port)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        assert (await request(bad_reader, bad_writer, '[1,2]'))['reason'] == 'malformed request'
+        assert (await request(bad_reader, bad_writer, '5'))['type'] == 'reject'
+        reply = await request(bad_reader, bad_writer, {"op": "place", "instrument": [1], "side": "buy",
+                                                       "price": "1", "quantity": "1", "ref": 1})
+        assert (reply['type'], reply['ref']) == ('reject', 1)
+        reply = await request(bad_reader, bad_writer, {"op": "cancel", "order_id": [1], "ref": 2})
+        assert (reply['type'], reply['ref']) == ('reject', 2)
+
+        # the batcher survived, so another session still gets its reply
+        reply = await request(reader, writer, {"op": "place", "instrument": "X", "side": "buy", "price": "100",
+                                               "quantity": "1", "ref": 3})
+        assert (reply['type'], reply['ref']) == (events.ACCEPTED, 3)
+        assert not batcher.done()
+        bad_writer.close()
+        writer.close()
+    finally:
+        server.close()
+        batcher.cancel()
+
+
+def test_bad_requests_do_not_stop_other_sessions():
+    asyncio.run(badRequestsAreRejected())
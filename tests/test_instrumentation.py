@@ -0,0 +1,56 @@
+import random
+
+import MatchingEngine as engine
+import events
+import instrumentation
+from instrumentation import Histogram, bucketIndex, bucketValue
+
+
+def test_buckets_keep_values_to_a_sixteenth():
+    values = list(range(5000)) + [random.Random(3).randrange(1 << 62) for _ in range(5000)] + [(1 << 63) - 1]
+    for value in values:
+        index = bucketIndex(value)
+        assert 0 <= index < instrumentation.BUCKETS
+        assert value <= bucketValue(index) <= value + value // 16
+        assert index == 0 or bucketValue(index - 1) < value
+
+
+def test_percentiles_and_merge():
+    low, high = Histogram(), Histogram()
+    for value in range(1, 5001):
+        low.record(value)
+    for value in range(5001, 10001):
+        high.record(value)
+    low.merge(high)
+
+    assert (low.count, low.min, low.max, low.total) == (10000, 1, 10000, 10000 * 10001 // 2)
+    for q in (50, 90, 99, 99.9):
+        exact = q / 100 * 10000
+        assert exact <= low.percentile(q) <= exact * 17 / 16
+    assert low.percentile(100) == 10000
+    assert Histogram().percentile(50) is None
+    assert low.summary()["mean"] == 5000.5
+
+
+def test_engine_latencies_and_counters():
+    eng = engine.MatchingEngine(engine.PriceLevelBook, sink=events.NullSink(), default_spec=engine.InstrumentSpec(1, 1))
+    dumps = []
+    eng.enableInstrumentation(dump_interval=0, dump=dumps.append)
+    for price in (100, 101, 102):
+        eng.placeOrder('X', 'sell', price, 1)
+    eng.placeOrder('X', 'buy', 102, 3)
+    eng.cancelOrder(eng.placeOrder('Y', 'buy', 99, 1))
+
+    stats = eng.stats()
+    assert stats["counters"]["fills"] == 3
+    assert stats["counters"]["levels_swept"] == 3
+    latency = stats["latency"]
+    assert latency["processOrder"]["all"]["count"] == 5
+    assert latency["processOrder"]["instruments"]["Y"]["count"] == 1
+    assert latency["cancelOrder"]["instruments"]["Y"]["count"] == 1
+    assert latency["acknowledgeOrder"]["all"]["count"] == 6
+    assert dumps
+
+    eng.disableInstrumentation()
+    assert 'processOrder' not in vars(eng)
+    assert "latency" not in eng.stats()
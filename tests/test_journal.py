@@ -0,0 +1,190 @@
+import functools
+import random
+
+import pytest
+
+import MatchingEngine as engine
+import events
+import journal
+
+BOOKS = [
+    pytest.param(engine.OrderBook, id='heap'),
+    pytest.param(functools.partial(engine.OrderBook, lazy=True), id='heap_lazy'),
+    pytest.param(engine.PriceLevelBook, id='price_level'),
+]
+
+
+def newEngine(book_factory, path, **kwargs):
+    return engine.MatchingEngine(book_factory, sink=events.NullSink(), default_spec=engine.InstrumentSpec(1, 1),
+                                 journal_path=str(path), **kwargs)
+
+
+def state(eng):
+    """Everything replay has to reproduce: resting orders in priority order, stops and trades."""
+    books = {}
+    for instrument in sorted(set(eng.orderbooks) | set(eng.stopBooks)):
+        book = eng.orderbooks[instrument]
+        stops = eng.stopBooks.get(instrument)
+        books[instrument] = (
+            [(o.order_id, o.side, o.price, o.quantity, o.hidden, o.filled_quantity) for o in book.restingOrders()],
+            [(o.order_id, o.stop_price, o.quantity) for o in stops.orders()] if stops else [],
+            [(t.id, t.price, t.volume) for t in eng.getTrades(instrument)])
+    return books
+
+
+def replayed(eng, path, **kwargs):
+    eng.journal.close()
+    return journal.replay(str(path), book_factory=eng.orderbooks.default_factory, **kwargs)
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_iceberg_refill_replays_across_instruments(book_factory, tmp_path):
+    path = tmp_path / 'engine.journal'
+    eng = newEngine(book_factory, path)
+    eng.placeOrder('A', 'sell', 100, 1)
+    iceberg = eng.placeOrder('B', 'sell', 100, 3, display_quantity=1)
+    eng.placeOrder('B', 'buy', 100, 1)
+    eng.placeOrder('A', 'sell', 100, 1)
+    later = eng.placeOrder('B', 'sell', 100, 1)
+    eng.placeOrder('A', 'sell', 100, 1)
+    eng.placeOrder('B', 'buy', 100, 1)
+
+    # the refilled clip was queued before `later`, so it trades first and its last clip queues behind `later`
+    assert [trade.id for trade in eng.getTrades('B')] == [iceberg + 1, iceberg + 5]
+    assert [(o.order_id, o.quantity, o.hidden) for o in eng.orderbooks['B'].restingOrders()] == \
+        [(later, 1, 0), (iceberg, 1, 0)]
+
+    rebuilt = replayed(eng, path)
+    assert state(rebuilt) == state(eng)
+
+
+def workload(eng, seed=7, steps=3000):
+    """A seeded mix of every journaled command over two instruments."""
+    rnd = random.Random(seed)
+    for step in range(steps):
+        instrument = rnd.choice('XY')
+        side = rnd.choice(('buy', 'sell'))
+        price = rnd.randint(95, 105)
+        quantity = rnd.randint(1, 5)
+        owner = rnd.choice('abc')
+        roll = rnd.random()
+        if roll < 0.08:
+            eng.placeOrder(instrument, side, None, quantity, owner, engine.STOP, stop_price=rnd.randint(93, 107))
+        elif roll < 0.16:
+            eng.placeOrder(instrument, side, price, quantity, owner, engine.STOP_LIMIT,
+                           stop_price=rnd.randint(93, 107))
+        elif roll < 0.24:
+            eng.placeOrder(instrument, side, price, quantity + 5, owner, display_quantity=2)
+        elif roll < 0.28:
+            eng.placeOrder(instrument, side, price, quantity, owner, rnd.choice((engine.IOC, engine.FOK)))
+        elif roll < 0.32:
+            eng.placeOrder(instrument, side, price, quantity, owner, expire_at=rnd.choice((engine.DAY, step + 50)))
+        elif roll < 0.40 and eng.orders:
+            eng.cancelOrder(rnd.choice(list(eng.orders)))
+        elif roll < 0.46 and eng.orders:
+            eng.amendOrder(rnd.choice(list(eng.orders)), rnd.randint(95, 105), rnd.randint(1, 6))
+        elif roll < 0.47:
+            eng.cancelAll(owner)
+        elif roll < 0.48:
+            eng.cancelInstrument(instrument, rnd.choice(('buy', 'sell', None)))
+        elif roll < 0.50:
+            eng.expireOrders(step)
+        elif roll < 0.505:
+            eng.endOfDay()
+        else:
+            eng.placeOrder(instrument, side, price, quantity, owner)
+
+
+@pytest.mark.parametrize('self_trade', engine.SELF_TRADE_MODES + (None,))
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_replay_matches_live_run(book_factory, self_trade, tmp_path):
+    path = tmp_path / 'engine.journal'
+    eng = newEngine(book_factory, path, self_trade=self_trade)
+    workload(eng)
+
+    rebuilt = replayed(eng, path, self_trade=self_trade)
+    assert state(rebuilt) == state(eng)
+    assert rebuilt.sequencer.last == eng.sequencer.last
+
+
+@pytest.mark.parametrize('self_trade', engine.SELF_TRADE_MODES)
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_every_book_matches_the_price_level_book(book_factory, self_trade):
+    engines = [engine.MatchingEngine(factory, sink=events.NullSink(), default_spec=engine.InstrumentSpec(1, 1),
+                                     self_trade=self_trade)
+               for factory in (book_factory, engine.PriceLevelBook)]
+    for eng in engines:
+        workload(eng, seed=11)
+    assert state(engines[0]) == state(engines[1])
+
+
+def test_records_round_trip(tmp_path):
+    path = tmp_path / 'engine.journal'
+    log = journal.Journal(str(path), session=42)
+    order = engine.Order('X', 7, 'sell', 101, 5, 123, owner='desk', order_type=engine.STOP_LIMIT, stop_price=100,
+                         display=2, expire_at=engine.DAY)
+    log.logPlace(order)
+    log.logPlace(engine.Order('Y', 8, 'buy', engine.MARKET_PRICES['buy'], 3, 124, order_type=engine.MARKET))
+    log.logCancel(7)
+    log.logConfigure('X', '0.5', '1')
+    log.logCancelAll('desk')
+    log.logCancelInstrument('Y', None)
+    log.logAmend(8, None, 2)
+    log.logExpire(999)
+    log.logEndOfDay()
+    log.close()
+
+    with open(path, 'rb') as f:
+        buf = f.read()
+    assert journal.readHeader(buf, path) == 42
+    assert list(journal.iterRecords(buf)) == [
+        (journal.PLACE, 7, 'X', 'sell', 101, 5, 123, 'desk', engine.STOP_LIMIT, 100, 2, engine.DAY),
+        (journal.PLACE, 8, 'Y', 'buy', engine.MARKET_PRICES['buy'], 3, 124, None, engine.MARKET, None, None, None),
+        (journal.CANCEL, 7),
+        (journal.CONFIGURE, 'X', '0.5', '1'),
+        (journal.CANCEL_ALL, 'desk'),
+        (journal.CANCEL_INSTRUMENT, 'Y', None),
+        (journal.AMEND, 8, None, 2),
+        (journal.EXPIRE, 999),
+        (journal.END_OF_DAY,),
+    ]
+    # a record torn by a crash mid-write ends the journal
+    assert len(list(journal.iterRecords(buf[:-3]))) == 7
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_crash_recover_keep_journaling_replay_again(book_factory, tmp_path):
+    path = tmp_path / 'engine.journal'
+    eng = newEngine(book_factory, path)
+    eng.placeOrder('X', 'sell', 100, 5)
+    eng.placeOrder('X', 'sell', 101, 5)
+    eng.journal.close()
+    torn = path.stat().st_size - 5
+    with open(path, 'r+b') as f:
+        f.truncate(torn)
+
+    recovered = journal.replay(str(path), book_factory=book_factory, default_spec=engine.InstrumentSpec(1, 1))
+    recovered.openJournal(str(path))
+    # the torn record's bytes are gone before anything is appended
+    assert path.stat().st_size < torn
+    recovered.placeOrder('X', 'buy', 100, 2)
+
+    rebuilt = replayed(recovered, path, default_spec=engine.InstrumentSpec(1, 1))
+    assert state(rebuilt) == state(recovered)
+    assert [(o.price, o.quantity) for o in rebuilt.orderbooks['X'].restingOrders()] == [(100, 3)]
+
+
+def test_batch_is_on_disk_when_placeOrders_returns(tmp_path):
+    path = tmp_path / 'engine.journal'
+    eng = newEngine(engine.PriceLevelBook, path)
+    eng.journal.sync_interval = 3600
+    batch = engine.newBatch(engine.NEW_ORDER_COLUMNS)
+    for i in range(50):
+        for name, value in zip(engine.NEW_ORDER_COLUMNS,
+                               ('X', 'buy' if i % 2 else 'sell', 100, 1, None, engine.LIMIT, None, None, None)):
+            batch[name].append(value)
+    eng.placeOrders(batch, scaled=True)
+
+    assert not eng.journal.buffer
+    with open(path, 'rb') as f:
+        assert len(list(journal.iterRecords(f.read()))) == 50
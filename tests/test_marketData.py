@@ -0,0 +1,58 @@
+import pytest
+
+import MatchingEngine as engine
+import events
+from marketData import DepthSnapshot, DepthUpdate, MarketDataPublisher, TopOfBook
+from test_journal import BOOKS, workload
+
+
+def applyUpdate(levels, update):
+    side = levels[update.side]
+    if update.size:
+        side[update.price] = update.size
+    else:
+        side.pop(update.price, None)
+
+
+def depth(levels):
+    return (sorted(levels['buy'].items(), reverse=True), sorted(levels['sell'].items()))
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_updates_rebuild_every_book(book_factory):
+    eng = engine.MatchingEngine(book_factory, sink=events.NullSink(), default_spec=engine.InstrumentSpec(1, 1))
+    messages = []
+    publisher = MarketDataPublisher(eng, messages.append, snapshot_every=100)
+    workload(eng, seed=1, steps=1000)
+    late = publisher.snapshot('X')
+    joined = len(messages)
+    workload(eng, seed=2, steps=1000)
+
+    books, seqs, tops = {}, {}, {}
+    for message in messages:
+        levels = books.setdefault(message.instrument, {'buy': {}, 'sell': {}})
+        if isinstance(message, DepthSnapshot):
+            # periodic snapshots show the book as the updates so far built it
+            assert message.seq == seqs[message.instrument]
+            assert (message.bids, message.asks) == depth(levels)
+            continue
+        assert message.seq == seqs.get(message.instrument, 0) + 1
+        seqs[message.instrument] = message.seq
+        if isinstance(message, DepthUpdate):
+            applyUpdate(levels, message)
+        else:
+            assert isinstance(message, TopOfBook)
+            tops[message.instrument] = message[2:]
+    assert any(isinstance(message, DepthSnapshot) for message in messages)
+
+    for instrument, levels in books.items():
+        book = eng.orderbooks[instrument]
+        assert depth(levels) == book.depth()
+        assert tops[instrument] == book.topOfBook()
+
+    # a late joiner starts from a snapshot and applies the updates after its seq
+    levels = {'buy': dict(late.bids), 'sell': dict(late.asks)}
+    for message in messages[joined:]:
+        if message.instrument == 'X' and isinstance(message, DepthUpdate) and message.seq > late.seq:
+            applyUpdate(levels, message)
+    assert depth(levels) == eng.orderbooks['X'].depth()
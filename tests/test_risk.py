@@ -0,0 +1,103 @@
+import pytest
+
+import MatchingEngine as engine
+import events
+from test_journal import BOOKS, workload
+
+
+def newEngine(book_factory, trade_retention=100000, **limits):
+    rejects = []
+    sink = events.CallbackSink(lambda event: rejects.append(event.reason) if event.kind == events.REJECT else None)
+    eng = engine.MatchingEngine(book_factory, sink=sink, default_spec=engine.InstrumentSpec(1, 1),
+                                trade_retention=trade_retention)
+    return eng, eng.enableRiskChecks(**limits), rejects
+
+
+def recomputed(eng):
+    """Every owner's (open notional, open buys, open sells) counted from scratch off the books."""
+    accounts = {}
+    for book in eng.orderbooks.values():
+        for order in book.restingOrders():
+            if order.owner is None:
+                continue
+            notional, buys, sells = accounts.setdefault(order.owner, [0, {}, {}])
+            size = order.quantity + order.hidden
+            accounts[order.owner][0] = notional + size * order.price
+            lots = buys if order.side == 'buy' else sells
+            lots[order.instrument] = lots.get(order.instrument, 0) + size
+    return accounts
+
+
+@pytest.mark.parametrize('retention', [100000, 0])
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_order_size_and_price_band(book_factory, retention):
+    # the last trade price is the reference even once no trade is kept in memory
+    eng, _, rejects = newEngine(book_factory, retention, max_order_size=5, price_band=0.1)
+    eng.placeOrder('X', 'sell', 100, 6)
+    assert rejects == [events.ORDER_TOO_LARGE]
+
+    # nothing traded yet: the band is around the mid
+    eng.placeOrder('X', 'buy', 90, 5)
+    eng.placeOrder('X', 'sell', 110, 5)
+    eng.placeOrder('X', 'sell', 111, 1)
+    assert rejects[1:] == [events.OUTSIDE_PRICE_BAND]
+
+    # then around the last trade
+    eng.placeOrder('X', 'buy', 110, 1)
+    eng.placeOrder('X', 'buy', 122, 1)
+    eng.placeOrder('X', 'buy', 98, 1)
+    assert rejects[2:] == [events.OUTSIDE_PRICE_BAND, events.OUTSIDE_PRICE_BAND]
+    assert [order.price for order in eng.orderbooks['X'].restingOrders()] == [90, 110]
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_open_notional_counts_iceberg_reserves_and_nets_amends(book_factory):
+    eng, check, rejects = newEngine(book_factory, max_open_notional=1000)
+    iceberg = eng.placeOrder('X', 'buy', 100, 10, owner='a', display_quantity=2)
+    assert check.accounts['a'].openNotional == 1000
+    assert check.reserves == {iceberg: 8}
+
+    eng.placeOrder('X', 'buy', 99, 1, owner='a')
+    assert rejects == [events.NOTIONAL_LIMIT]
+
+    # the amended order replaces the exposure of the one it changes
+    assert eng.amendOrder(iceberg, 99, 10)
+    assert check.accounts['a'].openNotional == 990
+    eng.placeOrder('X', 'buy', 98, 1, owner='b')
+    assert rejects == [events.NOTIONAL_LIMIT]
+
+    eng.placeOrder('X', 'sell', 99, 3)
+    assert check.accounts['a'].openNotional == 7 * 99
+    assert check.accounts['a'].openBuys == {'X': 7}
+    eng.cancelOrder(iceberg)
+    assert (check.accounts['a'].openNotional, check.accounts['a'].openBuys, check.reserves) == (0, {'X': 0}, {})
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_position_limit_counts_fills_and_resting_orders(book_factory):
+    eng, check, rejects = newEngine(book_factory, max_position=5, account_limits={'b': {'max_position': 1}})
+    eng.placeOrder('X', 'sell', 100, 3)
+    eng.placeOrder('X', 'buy', 100, 3, owner='a')
+    eng.placeOrder('X', 'buy', 99, 2, owner='a')
+    eng.placeOrder('X', 'buy', 99, 1, owner='a')
+    assert rejects == [events.POSITION_LIMIT]
+    assert check.exposure('a')['instruments']['X'] == {"position": 3, "open_buys": 2, "open_sells": 0}
+
+    # selling is checked against the short side, and account limits override the default
+    eng.placeOrder('X', 'sell', 101, 8, owner='a')
+    eng.placeOrder('X', 'sell', 101, 9, owner='a')
+    eng.placeOrder('X', 'buy', 98, 2, owner='b')
+    assert rejects[1:] == [events.POSITION_LIMIT, events.POSITION_LIMIT]
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_open_exposure_matches_the_books(book_factory):
+    eng, check, _ = newEngine(book_factory)
+    workload(eng, seed=5)
+    expected = recomputed(eng)
+
+    for owner, account in check.accounts.items():
+        notional, buys, sells = expected.get(owner, (0, {}, {}))
+        assert account.openNotional == pytest.approx(notional)
+        assert {instrument: lots for instrument, lots in account.openBuys.items() if lots} == buys
+        assert {instrument: lots for instrument, lots in account.openSells.items() if lots} == sells
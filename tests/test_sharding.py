@@ -0,0 +1,20 @@
+import MatchingEngine as engine
+import events
+import sharding
+
+
+def test_large_replies_do_not_deadlock_and_done_orders_leave_the_map():
+    fills = []
+    router = sharding.ShardRouter(1, batch_size=4000, sink=events.CallbackSink(fills.append),
+                                  default_spec=engine.InstrumentSpec(1, 1))
+    try:
+        # every order crosses, so each reply carries more events and acks than its batch has commands
+        for i in range(20000):
+            router.placeOrder('X', 'buy' if i % 2 else 'sell', 100, 1)
+        resting = router.placeOrder('X', 'sell', 101, 1)
+        router.flush()
+
+        assert sum(event.kind == events.FILL for event in fills) == 20000
+        assert router.shardOf == {resting: 0}
+    finally:
+        router.close()
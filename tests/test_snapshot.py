@@ -0,0 +1,54 @@
+import pytest
+
+import MatchingEngine as engine
+import events
+from test_journal import BOOKS, newEngine, state, workload
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_snapshot_round_trip(book_factory, tmp_path):
+    eng = newEngine(book_factory, tmp_path / 'engine.journal')
+    eng.configureInstrument('Z', '0.5', '2')
+    workload(eng)
+    eng.snapshot(str(tmp_path / 'engine.snapshot'))
+
+    restored = engine.MatchingEngine.from_snapshot(str(tmp_path / 'engine.snapshot'), book_factory=book_factory,
+                                                   sink=events.NullSink())
+    assert restored.sequencer.last == eng.sequencer.last
+    assert restored.spec('Z').lot_size == eng.spec('Z').lot_size
+    resting = {instrument: books[:2] for instrument, books in state(eng).items()}
+    for instrument in resting:
+        restored.orderbooks[instrument]  # books are rebuilt from the snapshot on first use
+    assert {instrument: books[:2] for instrument, books in state(restored).items()} == resting
+    for order_id, order in eng.orders.items():
+        if order.quantity:
+            copy = restored.lookupOrder(order_id)
+            assert (copy.owner, copy.order_type, copy.display, copy.hidden, copy.expire_at) == \
+                (order.owner, order.order_type, order.display, order.hidden, order.expire_at)
+
+
+@pytest.mark.parametrize('book_factory', BOOKS)
+def test_snapshot_plus_journal_tail_matches_live_run(book_factory, tmp_path):
+    path = tmp_path / 'engine.journal'
+    eng = newEngine(book_factory, path, self_trade=engine.DECREMENT)
+    workload(eng, seed=3, steps=1500)
+    eng.placeOrder('S', 'sell', 100, 1)
+    eng.placeOrder('S', 'buy', 100, 1)
+    eng.placeOrder('S', 'sell', 105, 5)
+    eng.snapshot(str(tmp_path / 'engine.snapshot'))
+    workload(eng, seed=4, steps=1500)
+    # the trade at 100 is in the snapshot, not the journal tail, yet triggers this stop right away
+    eng.placeOrder('S', 'buy', None, 1, order_type=engine.STOP, stop_price=99)
+    assert [o.quantity for o in eng.orderbooks['S'].restingOrders()] == [4]
+    eng.journal.close()
+
+    restored = engine.MatchingEngine.from_snapshot(str(tmp_path / 'engine.snapshot'), journal_path=str(path),
+                                                   book_factory=book_factory, sink=events.NullSink(),
+                                                   self_trade=engine.DECREMENT)
+    # trades before the snapshot are not part of it
+    assert ({instrument: books[:2] for instrument, books in state(restored).items()} ==
+            {instrument: books[:2] for instrument, books in state(eng).items()})
+    tail = {instrument: books[2] for instrument, books in state(restored).items()}
+    for instrument, trades in tail.items():
+        assert trades == state(eng)[instrument][2][-len(trades):]
+    restored.journal.close()
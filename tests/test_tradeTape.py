@@ -0,0 +1,52 @@
+import MatchingEngine as engine
+import events
+from tradeTape import BarSeries, Trade, TradeTape
+
+
+def tape(trades, **kwargs):
+    tape = TradeTape('A/B', **kwargs)
+    for i, (timestamp, price, volume) in enumerate(trades):
+        tape.append(Trade(100 + i, 'A/B', price, volume, timestamp))
+    return tape
+
+
+def test_spilled_trades_read_back_with_the_recent_ones(tmp_path):
+    trades = [(i, 1000 + i % 7, 1 + i % 3) for i in range(5000)]
+    spilled = tape(trades, retention=3, spill_dir=str(tmp_path))
+    assert (len(spilled), spilled.first, len(spilled.recent)) == (5000, 4998, 3)
+    assert spilled.lastPrice == trades[-1][1]
+
+    read = [(t.seq, t.id, t.timestamp, t.price, t.volume) for t in spilled.trades(1)]
+    assert read == [(i + 1, 100 + i, *trade) for i, trade in enumerate(trades)]
+    assert [t.seq for t in spilled.trades(4990, 5000)] == list(range(4990, 5000))
+    assert [t.seq for t in spilled.trades()] == [4998, 4999, 5000]
+    spilled.close()
+
+    # without a spill file the old trades are gone
+    dropped = tape(trades, retention=3)
+    assert [t.seq for t in dropped.trades(1)] == [4998, 4999, 5000]
+
+
+def test_bars():
+    series = BarSeries(10, retention=2)
+    for timestamp, price, volume in [(1, 100, 1), (5, 104, 3), (9, 98, 1), (12, 101, 2), (35, 99, 1)]:
+        series.update(timestamp, price, volume)
+
+    bars = [(b.start, b.open, b.high, b.low, b.close, b.volume, b.count) for b in series.bars()]
+    assert bars == [(0, 100, 104, 98, 98, 5, 3), (10, 101, 101, 101, 101, 2, 1), (30, 99, 99, 99, 99, 1, 1)]
+    assert series.bars()[0].vwap == (100 + 104 * 3 + 98) / 5
+
+    series.update(41, 100, 1)
+    assert [b.start for b in series.bars()] == [10, 30, 40]
+
+
+def test_engine_tapes_spill_and_build_bars(tmp_path):
+    eng = engine.MatchingEngine(engine.PriceLevelBook, sink=events.NullSink(), default_spec=engine.InstrumentSpec(1, 1),
+                                trade_retention=2, spill_dir=str(tmp_path), bar_intervals=(60 * 10**9,))
+    eng.placeOrder('X', 'sell', 100, 5)
+    ids = [eng.placeOrder('X', 'buy', 100, 1) for _ in range(5)]
+
+    assert [(t.id, t.price, t.volume) for t in eng.getTrades('X', 1)] == [(i, 100, 1) for i in ids]
+    (bar,) = eng.getBars('X', 60 * 10**9)
+    assert (bar.open, bar.close, bar.volume, bar.count) == (100, 100, 5, 5)
+    eng.trades.close()
@@ -0,0 +1,184 @@
+from collections import defaultdict, deque
+from itertools import islice
+import os
+import struct
+from urllib.parse import quote
+
+# seq, order_id, timestamp, price (ticks), volume (lots)
+SPILL_RECORD = struct.Struct('<QQqqq')
+READ_CHUNK = 4096  # records per read from a spill file
+
+
+class Bar:
+    """OHLCV of the trades whose timestamp falls in [start, start + interval)."""
+
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume', 'notional', 'count')
+
+    def __init__(self, start, price, volume):
+        self.start = start
+        self.open = self.high = self.low = self.close = price
+        self.volume = volume
+        self.notional = price * volume
+        self.count = 1
+
+    def update(self, price, volume):
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += volume
+        self.notional += price * volume
+        self.count += 1
+
+    @property
+    def vwap(self):
+        return self.notional / self.volume if self.volume else None
+
+    def __repr__(self):
+        return (f"Bar(start={self.start}, open={self.open}, high={self.high}, low={self.low}, "
+                f"close={self.close}, volume={self.volume}, vwap={self.vwap})")
+
+
+class BarSeries:
+    """Bars of one interval (in ns), built as trades arrive; keeps the last `retention`."""
+
+    def __init__(self, interval, retention=1440):
+        self.interval = interval
+        self.closed = deque(maxlen=retention)
+        self.current = None
+
+    def update(self, timestamp, price, volume):
+        current = self.current
+        start = timestamp - timestamp % self.interval
+        if current is None or start > current.start:
+            if current is not None:
+                self.closed.append(current)
+            self.current = Bar(start, price, volume)
+        else:
+            current.update(price, volume)
+
+    def bars(self):
+        bars = list(self.closed)
+        if self.current is not None:
+            bars.append(self.current)
+        return bars
+
+
+class Trade:
+    __slots__ = ('id', 'name', 'price', 'volume', 'timestamp', 'seq')
+
+    def __init__(self, id, name, price, volume, timestamp=0):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.volume = volume
+        self.timestamp = timestamp
+        self.seq = 0
+
+
+class TradeTape:
+    """Trades of one instrument, numbered by seq from 1.
+
+    The last `retention` trades stay in memory. Older ones are appended to
+    `<spill_dir>/<instrument>.trades` as fixed-size records when a spill
+    directory is given, and dropped otherwise. trades(start, stop) reads a
+    seq range from either place. Bars for every interval in `bar_intervals`
+    (ns) are updated per trade.
+    """
+
+    def __init__(self, instrument, retention=100000, spill_dir=None, bar_intervals=()):
+        self.instrument = instrument
+        self.retention = retention
+        self.recent = deque()
+        self.seq = 0  # seq of the last trade
+        self.lastPrice = None  # of the last trade, kept when it leaves `recent`; stops trigger off it
+        self.first = 1  # seq of recent[0]
+        self.spillPath = None
+        self.spillFile = None
+        if spill_dir is not None:
+            self.spillPath = os.path.join(spill_dir, quote(instrument, safe='') + '.trades')
+            self.spillFile = open(self.spillPath, 'wb')
+        self.bars = {interval: BarSeries(interval) for interval in bar_intervals}
+
+    def append(self, trade):
+        self.seq += 1
+        trade.seq = self.seq
+        self.lastPrice = trade.price
+        recent = self.recent
+        recent.append(trade)
+        if len(recent) > self.retention:
+            old = recent.popleft()
+            self.first += 1
+            if self.spillFile is not None:
+                self.spillFile.write(SPILL_RECORD.pack(old.seq, old.id, old.timestamp, old.price, old.volume))
+        for series in self.bars.values():
+            series.update(trade.timestamp, trade.price, trade.volume)
+
+    def __len__(self):
+        return self.seq
+
+    def __iter__(self):
+        return iter(self.recent)
+
+    def trades(self, start=None, stop=None):
+        """Yield the trades with start <= seq < stop, oldest first.
+
+        `start` defaults to the oldest trade still in memory and `stop` to
+        the end of the tape. Trades that were spilled are read back from the
+        spill file; ones dropped without a spill file are skipped.
+        """
+        if start is None:
+            start = self.first
+        start = max(start, 1)
+        stop = self.seq + 1 if stop is None else min(stop, self.seq + 1)
+
+        if start < self.first and self.spillFile is not None:
+            yield from self.spilled(start, min(stop, self.first))
+        if stop > self.first:
+            recent = self.recent
+            lo, hi = max(start, self.first) - self.first, stop - self.first
+            if hi - lo > len(recent) // 2:
+                yield from islice(recent, lo, hi)
+            else:
+                # deque indexing is cheap near either end, e.g. the trades one order just made
+                for i in range(lo, hi):
+                    yield recent[i]
+
+    def spilled(self, start, stop):
+        self.spillFile.flush()
+        with open(self.spillPath, 'rb') as f:
+            f.seek((start - 1) * SPILL_RECORD.size)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(remaining, READ_CHUNK) * SPILL_RECORD.size)
+                if not chunk:
+                    return
+                for seq, order_id, timestamp, price, volume in SPILL_RECORD.iter_unpack(chunk):
+                    trade = Trade(order_id, self.instrument, price, volume, timestamp)
+                    trade.seq = seq
+                    yield trade
+                remaining -= len(chunk) // SPILL_RECORD.size
+
+    def close(self):
+        if self.spillFile is not None:
+            self.spillFile.close()
+            self.spillFile = None
+
+
+class TradeTapes(defaultdict):
+    """instrument -> TradeTape, created with the same settings on first use."""
+
+    def __init__(self, retention=100000, spill_dir=None, bar_intervals=()):
+        super().__init__()
+        self.retention = retention
+        self.spill_dir = spill_dir
+        self.bar_intervals = tuple(bar_intervals)
+
+    def __missing__(self, instrument):
+        tape = self[instrument] = TradeTape(instrument, self.retention, self.spill_dir, self.bar_intervals)
+        return tape
+
+    def close(self):
+        for tape in self.values():
+            tape.close()